@@ -56,16 +56,28 @@ import logging
 import re
 import base64
 import cgi
+import collections
 import pickle
 import os
+import copy
+import functools
+import hashlib
+import itertools
+import math
+import random
+import time
+import threading
 
 from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.api import datastore_errors
 from google.appengine.ext import db
 from google.appengine.ext import blobstore
 from google.appengine.api import namespace_manager
 from google.appengine.ext.db import metadata
 from xml.dom import minidom
 from datetime import datetime
+from datetime import timedelta
 
 # use faster json if available
 try:
@@ -99,14 +111,112 @@ def get_type_name(value_type):
 METADATA_PATH = "metadata"
 CONTENT_PATH = "content"
 BLOBUPLOADRESULT_PATH = "__blob_result"
+BATCH_PATH = "$batch"
+
+# batch requests contain a list of operations (at most MAX_BATCH_OPS) like
+# <op method="GET" path="/<type>/<key>"/>, the response contains a result
+# (with a status code) for each operation
+MAX_BATCH_OPS = 500
+BATCH_EL_NAME = "batch"
+BATCH_OP_EL_NAME = "op"
+BATCH_RESULT_EL_NAME = "result"
+METHOD_ATTR_NAME = "method"
+PATH_ATTR_NAME = "path"
+STATUS_ATTR_NAME = "status"
+
+# batch deletes take a comma separated key list in the path (or a list of
+# keys in the body), of at most MAX_DELETE_KEYS keys
+KEY_LIST_SEP = ","
+MAX_DELETE_KEYS = 500
+
+# read/delete authorization decisions are remembered per (principal,
+# operation, key), for the current request and optionally (see
+# Dispatcher.auth_cache_time) across requests by each instance
+AUTH_OP_READ = "read"
+AUTH_OP_DELETE = "delete"
+MAX_AUTH_DECISIONS = 4096
 
 MAX_FETCH_PAGE_SIZE = 1000
 
+# memcache rejects values over 1MB, so larger cached values are split into
+# multiple chunks (written under separate keys) and reassembled using a small
+# manifest stored under the original key
+CACHE_CHUNK_SIZE = 1000000 - 1024
+MAX_CACHE_CHUNKS = 32
+CACHE_CHUNK_KEY_FORMAT = ":chunk%d"
+CACHE_CHUNK_MANIFEST_PREFIX = "__chunked__:"
+
+# cached responses, cache locks and cached etags always live in the default
+# memcache namespace (their keys already include any datastore namespace),
+# regardless of the namespace selected by the current request
+CACHE_NAMESPACE = ""
+
+# maximum number of parsed gql queries kept for re-use
+MAX_COMPILED_QUERIES = 256
+GQL_QUERY_FORMAT = "SELECT %s FROM %s %s"
+GQL_SELECT_ALL = "*"
+GQL_SELECT_KEYS = "__key__"
+
+# prefix for the memcache "lease" which allows only a single request to
+# recompute an expired cached response
+CACHE_LOCK_PREFIX = "__lock__:"
+CACHE_LOCK_POLL_INTERVAL = 0.05
+
+# prefixes for the memcache entries which allow 'If-None-Match' requests to
+# be answered without touching the datastore
+ETAG_CACHE_PREFIX = "__etag__:"
+QUERY_ETAG_CACHE_PREFIX = "__qetag__:"
+
+# prefix for the memcache entries mapping (query, numeric offset) -> cursor
+OFFSET_CURSOR_CACHE_PREFIX = "__offset__:"
+
+# prefixes for cached aggregate results, which are keyed on a per kind
+# counter incremented by every write made through the handler.  the counter
+# starts at the current time (in ms), so a counter evicted from memcache
+# never restarts at a generation used before
+AGGREGATE_CACHE_PREFIX = "__aggregate__:"
+WRITE_GENERATION_PREFIX = "__writegen__:"
+
+# principals resolved by a CachingAuthenticator, keyed by a digest of the
+# request credentials (also cached in-process, for at most
+# MAX_CACHED_PRINCIPALS credentials)
+PRINCIPAL_CACHE_PREFIX = "__principal__:"
+MAX_CACHED_PRINCIPALS = 1024
+
+# per query shape statistics (see QueryStats).  counters are kept in memcache
+# under "<prefix><shape id>:<counter>", latencies are bucketed using the
+# given upper bounds (in ms)
+QUERY_STATS_PATH = "__query_stats"
+QUERY_STATS_CACHE_PREFIX = "__qstats__:"
+QUERY_STATS_SHAPES_KEY = "__qstats_shapes__"
+QUERY_STATS_SEP = ":"
+QUERY_STATS_SHAPE = "shape"
+QUERY_STATS_COUNT = "count"
+QUERY_STATS_MODELS = "models"
+QUERY_STATS_NEED_INDEX = "need_index"
+QUERY_STATS_FETCH = "fetch"
+QUERY_STATS_OUTPUT = "output"
+QUERY_STATS_TOTAL_MS = "total_ms"
+QUERY_STATS_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+QUERY_STATS_OVERFLOW_BUCKET = "inf"
+QUERY_STATS_MAX_CAS_RETRIES = 5
+QUERY_STATS_TYPE_INDEX = "index"
+QUERY_STATS_EL_NAME = "query_stats"
+SHAPE_EL_NAME = "shape"
+FILTERS_ATTR_NAME = "filters"
+BUCKET_EL_NAME = "bucket"
+BUCKET_LIMIT_ATTR_NAME = "le"
+
 XML_CLEANSE_PATTERN1 = re.compile(r"^(\d)")
 XML_CLEANSE_REPL1 = r"_\1"
 XML_CLEANSE_PATTERN2 = re.compile(r"[^a-zA-Z0-9_\-]")
 XML_CLEANSE_REPL2 = r"_"
 
+# maximum number of memoized xml names (see convert_to_valid_xml_name()) and
+# of dynamic property handlers kept per Expando model
+MAX_XML_NAMES = 4096
+MAX_DYNAMIC_HANDLERS = 512
+
 EMPTY_VALUE = object()
 MULTI_UPDATE_KEY = object()
 
@@ -121,6 +231,7 @@ TYPE_ATTR_NAME = "type"
 NAME_ATTR_NAME = "name"
 BASE_ATTR_NAME = "base"
 ETAG_ATTR_NAME = "etag"
+UNCHANGED_ATTR_NAME = "unchanged"
 PROPERTY_ATTR_NAME = "property"
 REQUIRED_ATTR_NAME = "required"
 DEFAULT_ATTR_NAME = "default"
@@ -138,6 +249,16 @@ DATE_FORMAT = "%Y-%m-%d"
 TIME_FORMAT_NO_MS = "%H:%M:%S"
 DATE_TIME_FORMAT_NO_MS = DATE_FORMAT + DATE_TIME_SEP + TIME_FORMAT_NO_MS
 
+# fixed layouts of the above formats, which are parsed without strptime
+# (other strings fall back to strptime)
+DATE_TIME_LAYOUTS = {
+    DATE_FORMAT: re.compile(r"^(\d{4})-(\d{2})-(\d{2})$"),
+    TIME_FORMAT_NO_MS: re.compile(r"^(\d{2}):(\d{2}):(\d{2})$"),
+    DATE_TIME_FORMAT_NO_MS: re.compile(
+        r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})$")}
+# date used by strptime for time only formats
+STRPTIME_DEFAULT_DATE = (1900, 1, 1)
+
 TRUE_VALUE = "true"
 TRUE_NUMERIC_VALUE = "1"
 
@@ -147,9 +268,15 @@ TEXT_CONTENT_TYPE = "text/plain"
 JSON_CONTENT_TYPE = "application/json"
 METHOD_OVERRIDE_HEADER = "X-HTTP-Method-Override"
 RANGE_HEADER = "Range"
+CONTENT_RANGE_HEADER = "Content-Range"
+ACCEPT_RANGES_HEADER = "Accept-Ranges"
+BYTES_RANGE_UNIT = "bytes"
+BYTE_RANGE_PATTERN = re.compile(r"^bytes\s*=\s*(\d*)\s*-\s*(\d*)$")
 BINARY_CONTENT_TYPE = "application/octet-stream"
 FORMDATA_CONTENT_TYPE = "multipart/form-data"
 ETAG_HEADER = "ETag"
+IF_NONE_MATCH_HEADER = "If-None-Match"
+UNCHANGED_HEADER = "X-Rest-Unchanged"
 
 JSON_TEXT_KEY = "#text"
 JSON_ATTR_PREFIX = "@"
@@ -208,15 +335,40 @@ QUERY_OFFSET_PARAM = "offset"
 QUERY_CURSOR_PREFIX = "c_"
 QUERY_PAGE_SIZE_PARAM = "page_size"
 QUERY_ORDERING_PARAM = "ordering"
-QUERY_TERM_PATTERN = re.compile(r"^(f.._)(.+)$")
+QUERY_TERM_PATTERN = re.compile(r"^(f.._|fbbox_|fnear_)(.+)$")
 QUERY_PREFIX = "WHERE "
 QUERY_JOIN = " AND "
 QUERY_ORDERBY = " ORDER BY "
 QUERY_ORDER_SUFFIXES = [" ASC", " DESC"]
+QUERY_ORDER_JOIN = ", "
+QUERY_ORDERING_SEPARATOR = ","
 QUERY_ORDER_PREFIXES = ["", "-"]
 QUERY_ORDER_ASC_IDX = 0
 QUERY_ORDER_DSC_IDX = 1
 QUERY_LIST_TYPE = "fin_"
+QUERY_PREFIX_TYPE = "fsw_"
+QUERY_INEQUALITY_TYPES = frozenset(["flt_", "fgt_", "fle_", "fge_", "fne_",
+                                    QUERY_PREFIX_TYPE])
+QUERY_BBOX_TYPE = "fbbox_"
+QUERY_NEAR_TYPE = "fnear_"
+QUERY_GEO_TYPES = frozenset([QUERY_BBOX_TYPE, QUERY_NEAR_TYPE])
+QUERY_GEO_SEPARATOR = ","
+
+# geohash index settings (see GeoIndex).  bounding boxes are covered by at
+# most MAX_GEO_COVER_CELLS geohash cells (each scanned as a key range)
+GEOHASH_CHARS = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 12
+MAX_GEO_COVER_CELLS = 16
+# geo queries scan at most MAX_GEO_CANDIDATES index entries per request
+# (bounding box queries per page, proximity queries per ring).  proximity
+# queries scan rings starting at 1/GEO_RING_SCALE of the radius, doubling
+# the ring radius until enough results are found.  bounding box queries are
+# resumed from a "<cell index>:<cell cursor>" cursor offset
+MAX_GEO_CANDIDATES = 2 * MAX_FETCH_PAGE_SIZE
+GEO_RING_SCALE = 64.0
+GEO_CURSOR_SEP = ":"
+GEO_CELL_SEP = "|"
+EARTH_RADIUS_KM = 6371.0
 
 QUERY_TYPE_PARAM = "type"
 QUERY_TYPE_FULL = "full"
@@ -233,6 +385,38 @@ QUERY_CALLBACK_PARAM = "callback"
 
 QUERY_INCLUDEPROPS_PARAM = "include_props"
 
+# slicing of single list property gets
+QUERY_START_PARAM = "start"
+QUERY_COUNT_PARAM = "count"
+
+# in-place (transactional) single property update operations
+QUERY_OP_PARAM = "op"
+LIST_OP_APPEND = "append"
+LIST_OP_REMOVE = "remove"
+LIST_OPS = frozenset([LIST_OP_APPEND, LIST_OP_REMOVE])
+NUMERIC_OP_INCR = "incr"
+QUERY_INCR_BY_PARAM = "by"
+COUNTER_SHARD_SEP = "|"
+
+QUERY_CHANGES_SINCE_PARAM = "changes_since"
+QUERY_DELETED_SINCE_PARAM = "deleted_since"
+DELETED_ATTR_NAME = "deleted"
+
+# highest (valid) unicode character, used as the upper bound of string range
+# filters
+MAX_UNICODE_CHAR = u"\ufffd"
+
+QUERY_AGGREGATE_PARAM = "aggregate"
+AGGREGATE_SEPARATOR = ":"
+AGGREGATE_COUNT = "count"
+AGGREGATE_SUM = "sum"
+AGGREGATE_MIN = "min"
+AGGREGATE_MAX = "max"
+AGGREGATE_FUNCS = frozenset([AGGREGATE_COUNT, AGGREGATE_SUM, AGGREGATE_MIN,
+                             AGGREGATE_MAX])
+AGGREGATE_EL_NAME = "aggregate"
+FUNCTION_ATTR_NAME = "function"
+
 EXTRA_QUERY_PARAMS = frozenset([QUERY_BLOBINFO_PARAM, QUERY_CALLBACK_PARAM,
                                 QUERY_INCLUDEPROPS_PARAM])
 
@@ -331,7 +515,17 @@ def parse_date_time(dt_str, dt_format, dt_type, allows_microseconds):
         dt_str = dt_parts.pop(0)
         if(len(dt_parts) > 0):
             micros = int(dt_parts[0].ljust(6, "0")[:6])
-    dtime = datetime.strptime(dt_str, dt_format)
+    dt_match = None
+    dt_layout = DATE_TIME_LAYOUTS.get(dt_format, None)
+    if dt_layout:
+        dt_match = dt_layout.match(dt_str)
+    if dt_match:
+        dt_fields = map(int, dt_match.groups())
+        if(dt_format == TIME_FORMAT_NO_MS):
+            dt_fields[0:0] = STRPTIME_DEFAULT_DATE
+        dtime = datetime(*dt_fields)
+    else:
+        dtime = datetime.strptime(dt_str, dt_format)
     if(micros):
         dtime = dtime.replace(microsecond=micros)
     if(dt_type is datetime.date):
@@ -341,10 +535,46 @@ def parse_date_time(dt_str, dt_format, dt_type, allows_microseconds):
     return dtime
 
 
+def parse_byte_range(range_header, length):
+    """Returns the (start, end) byte offsets (inclusive) of the single byte
+    range in the given Range header value for a value of the given length,
+    or None if the header should be ignored (malformed or multiple ranges).
+    The start offset is >= length if the range is not satisfiable."""
+    match = BYTE_RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if(not start):
+        if(not end):
+            return None
+        # suffix range, i.e. the last <end> bytes
+        suffix_length = int(end)
+        if(suffix_length == 0):
+            return (length, length)
+        return (max(length - suffix_length, 0), length - 1)
+    start = int(start)
+    if(not end):
+        return (start, length - 1)
+    end = int(end)
+    if(end < start):
+        return None
+    return (start, min(end, length - 1))
+
+
+# memoized results of convert_to_valid_xml_name()
+XML_NAMES = {}
+
+
 def convert_to_valid_xml_name(name):
     """Converts a string to a valid xml element name."""
-    name = re.sub(XML_CLEANSE_PATTERN1, XML_CLEANSE_REPL1, name)
-    return re.sub(XML_CLEANSE_PATTERN2, XML_CLEANSE_REPL2, name)
+    xml_name = XML_NAMES.get(name, None)
+    if xml_name is None:
+        xml_name = re.sub(XML_CLEANSE_PATTERN1, XML_CLEANSE_REPL1, name)
+        xml_name = re.sub(XML_CLEANSE_PATTERN2, XML_CLEANSE_REPL2, xml_name)
+        if(len(XML_NAMES) >= MAX_XML_NAMES):
+            XML_NAMES.clear()
+        XML_NAMES[name] = xml_name
+    return xml_name
 
 
 def append_child(parent_el, name, content=None, meta=None):
@@ -572,6 +802,237 @@ def is_list_type(obj):
     return isinstance(obj, (types.ListType, types.TupleType))
 
 
+def cache_set(key, value, cache_time):
+    """Stores the given string value in memcache under the given key,
+    splitting values which are too large for a single memcache entry into
+    multiple chunks.  Returns True if the value was stored, False
+    otherwise."""
+    if(len(value) <= CACHE_CHUNK_SIZE):
+        return memcache.set(key, value, cache_time,
+                            namespace=CACHE_NAMESPACE)
+
+    num_chunks = (len(value) + CACHE_CHUNK_SIZE - 1) // CACHE_CHUNK_SIZE
+    if(num_chunks > MAX_CACHE_CHUNKS):
+        logging.warning("value for %s too large to cache (%d bytes)", key,
+                        len(value))
+        return False
+
+    chunks = {}
+    for idx in range(0, num_chunks):
+        chunks[CACHE_CHUNK_KEY_FORMAT % idx] = (
+            value[idx * CACHE_CHUNK_SIZE:(idx + 1) * CACHE_CHUNK_SIZE])
+
+    # write the chunks before the manifest so that a reader never finds a
+    # manifest without its chunks (set_multi returns the keys _not_ set)
+    if memcache.set_multi(chunks, cache_time, key_prefix=key,
+                          namespace=CACHE_NAMESPACE):
+        return False
+
+    manifest = "%s%d:%d:%s" % (CACHE_CHUNK_MANIFEST_PREFIX, num_chunks,
+                               len(value), hashlib.md5(value).hexdigest())
+    return memcache.set(key, manifest, cache_time, namespace=CACHE_NAMESPACE)
+
+
+def cache_get(key):
+    """Returns the string value stored in memcache under the given key
+    (reassembling chunked values stored by cache_set()), or None if the value
+    is missing or incomplete."""
+    value = memcache.get(key, namespace=CACHE_NAMESPACE)
+    if((value is None) or
+       (not value.startswith(CACHE_CHUNK_MANIFEST_PREFIX))):
+        return value
+
+    num_chunks, value_len, checksum = (
+        value[len(CACHE_CHUNK_MANIFEST_PREFIX):].split(":", 2))
+    chunk_keys = [CACHE_CHUNK_KEY_FORMAT % idx
+                  for idx in range(0, int(num_chunks))]
+    chunks = memcache.get_multi(chunk_keys, key_prefix=key,
+                                namespace=CACHE_NAMESPACE)
+    if(len(chunks) != len(chunk_keys)):
+        # some chunks were evicted
+        return None
+
+    value = "".join([chunks[chunk_key] for chunk_key in chunk_keys])
+    if((len(value) != int(value_len)) or
+       (hashlib.md5(value).hexdigest() != checksum)):
+        # chunks from concurrent writes were mixed together
+        logging.warning("discarding corrupt cached value for %s", key)
+        return None
+
+    return value
+
+
+def get_typed_state(value):
+    """Returns a copy of the given (datastore) value which only compares
+    equal to the state of another value of the same type(s), see
+    ModelHandler.get_model_state()."""
+    if isinstance(value, list):
+        # lists may be modified in place
+        return [(type(item), item) for item in value]
+    return (type(value), value)
+
+
+def get_initial_write_generation():
+    """Returns the initial value for a new write generation counter (see
+    ModelHandler.get_write_generation()), the current time in ms, which is
+    larger than any generation of an earlier (evicted) counter unless the
+    counter was incremented more than once per ms."""
+    return int(time.time() * 1000)
+
+
+def digest_value(digest, value):
+    """Updates the given digest with a stable encoding of the given value
+    (including the value type, so that e.g. 1 and '1' differ)."""
+    if is_list_type(value):
+        digest.update("[%d:" % len(value))
+        for item in value:
+            digest_value(digest, item)
+        digest.update("]")
+        return
+
+    if isinstance(value, str):
+        value_str = value
+    elif isinstance(value, float):
+        # str() of a float drops precision
+        value_str = repr(value)
+    else:
+        value_str = unicode(value).encode("utf-8")
+    digest.update("%s:%d:" % (get_instance_type_name(value), len(value_str)))
+    digest.update(value_str)
+
+
+def digest_to_hash(digest):
+    """Returns the given digest as a (64 bit) hash value."""
+    return long(digest.hexdigest()[:16], 16)
+
+
+def stable_hash(value):
+    """Returns a hash of the given value which, unlike hash(), is the same in
+    every process."""
+    digest = hashlib.md5()
+    digest_value(digest, value)
+    return digest_to_hash(digest)
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    """Returns the geohash (with the given number of characters) of the given
+    location."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    num_bits = 0
+    is_lon = True
+    while(len(chars) < precision):
+        if is_lon:
+            coord_range, coord = lon_range, lon
+        else:
+            coord_range, coord = lat_range, lat
+        mid = (coord_range[0] + coord_range[1]) / 2
+        bits <<= 1
+        if(coord >= mid):
+            bits |= 1
+            coord_range[0] = mid
+        else:
+            coord_range[1] = mid
+        is_lon = not is_lon
+        num_bits += 1
+        if(num_bits == 5):
+            chars.append(GEOHASH_CHARS[bits])
+            bits = 0
+            num_bits = 0
+    return "".join(chars)
+
+
+def geohash_cover(south, west, north, east):
+    """Returns the geohashes of the (at most MAX_GEO_COVER_CELLS) cells
+    covering the given bounding box, using the longest geohashes possible.
+    The bounding box must not cross the antimeridian (see get_geo_boxes())."""
+    for precision in xrange(GEOHASH_PRECISION, 0, -1):
+        lon_bits = (precision * 5 + 1) // 2
+        lat_bits = (precision * 5) // 2
+        cell_width = 360.0 / (1 << lon_bits)
+        cell_height = 180.0 / (1 << lat_bits)
+        max_x_idx = (1 << lon_bits) - 1
+        max_y_idx = (1 << lat_bits) - 1
+        min_x = min(int((west + 180.0) // cell_width), max_x_idx)
+        max_x = min(int((east + 180.0) // cell_width), max_x_idx)
+        min_y = min(int((south + 90.0) // cell_height), max_y_idx)
+        max_y = min(int((north + 90.0) // cell_height), max_y_idx)
+        if(((max_x - min_x + 1) * (max_y - min_y + 1)) > MAX_GEO_COVER_CELLS):
+            continue
+
+        # encode the center of each cell
+        cells = set()
+        for x in xrange(min_x, max_x + 1):
+            for y in xrange(min_y, max_y + 1):
+                cells.add(geohash_encode(-90.0 + ((y + 0.5) * cell_height),
+                                         -180.0 + ((x + 0.5) * cell_width),
+                                         precision))
+        return sorted(cells)
+
+    # the whole world
+    return [""]
+
+
+def get_geo_boxes(south, west, north, east):
+    """Returns the given bounding box as a list of bounding boxes which do not
+    cross the antimeridian."""
+    if(west <= east):
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def get_near_box(lat, lon, radius):
+    """Returns the bounding box (south, west, north, east) containing all the
+    locations within the given radius (in km) of the given location."""
+    angle = radius / EARTH_RADIUS_KM
+    south = lat - math.degrees(angle)
+    north = lat + math.degrees(angle)
+    if((south <= -90.0) or (north >= 90.0)):
+        # includes a pole, so all longitudes are in range
+        return (max(south, -90.0), -180.0, min(north, 90.0), 180.0)
+    lon_angle = math.sin(angle) / math.cos(math.radians(lat))
+    if(lon_angle >= 1.0):
+        return (south, -180.0, north, 180.0)
+    lon_delta = math.degrees(math.asin(lon_angle))
+    west = lon - lon_delta
+    if(west < -180.0):
+        west += 360.0
+    east = lon + lon_delta
+    if(east > 180.0):
+        east -= 360.0
+    return (south, west, north, east)
+
+
+def is_in_geo_box(geo_box, lat, lon):
+    """Returns True if the given location is within the given bounding box
+    (which may cross the antimeridian), False otherwise."""
+    south, west, north, east = geo_box
+    if((lat < south) or (lat > north)):
+        return False
+    if(west <= east):
+        return (west <= lon <= east)
+    return ((lon >= west) or (lon <= east))
+
+
+def geo_distance(lat1, lon1, lat2, lon2):
+    """Returns the great circle distance (in km) between the given
+    locations."""
+    lat1, lon1, lat2, lon2 = [math.radians(c) for c in
+                              (lat1, lon1, lat2, lon2)]
+    a = ((math.sin((lat2 - lat1) / 2) ** 2) +
+         (math.cos(lat1) * math.cos(lat2) *
+          (math.sin((lon2 - lon1) / 2) ** 2)))
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def check_geo_point(lat, lon):
+    """Raises a ValueError if the given location is not valid."""
+    if((not (-90.0 <= lat <= 90.0)) or (not (-180.0 <= lon <= 180.0))):
+        raise ValueError("Invalid location %s,%s" % (lat, lon))
+
+
 def model_hash_to_str(model_hash):
     """Returns the model hash int as an encoded string."""
     return base64.b64encode(str(model_hash)).strip('=')
@@ -611,6 +1072,12 @@ class PropertyHandler(object):
         otherwise."""
         return self.property_type.indexed
 
+    def can_prefix_query(self):
+        """Returns True if this property can be used as a prefix ('starts
+        with') query filter, False otherwise."""
+        return (self.can_query() and
+                issubclass(self.get_data_type(), basestring))
+
     def get_data_type(self):
         """Returns the type of data this property accepts."""
         return self.property_type.data_type
@@ -730,10 +1197,46 @@ class PropertyHandler(object):
 
     def value_from_request(self, dispatcher, model, path):
         """Writes a single property from the dispatcher's response."""
-        value = self.value_from_raw_string(
-            dispatcher.request.body_file.getvalue())
+        value = self.value_from_raw_string(dispatcher.get_request_body())
         setattr(model, self.property_name, value)
 
+    def is_numeric(self):
+        """Returns True if this property holds (non-boolean) numbers, False
+        otherwise."""
+        data_type = self.get_data_type()
+        return (issubclass(data_type, (int, long, float)) and
+                (not issubclass(data_type, bool)))
+
+    def read_op_value(self, dispatcher, op, path):
+        """Returns the operand of the given in-place update operation (the
+        'op' query param) on this property, read from the dispatcher's
+        request.  Raises KeyError if the operation is not supported by this
+        property.  The default implementation supports 'incr' (by the 'by'
+        query param, defaulting to 1) on numeric properties."""
+        if((op == NUMERIC_OP_INCR) and (len(path) == 0) and
+           self.is_numeric()):
+            return self.get_data_type()(
+                dispatcher.get_query_param(QUERY_INCR_BY_PARAM, "1"))
+        raise KeyError("Unsupported operation %s on property %s" %
+                       (op, self.property_name))
+
+    def apply_op(self, model, op, op_value):
+        """Applies the given in-place update operation with the given operand
+        (see read_op_value()) to this property of the given model
+        instance."""
+        if(op == NUMERIC_OP_INCR):
+            setattr(model, self.property_name,
+                    (self.get_value(model) or 0) + op_value)
+            return
+        raise KeyError("Unsupported operation %s on property %s" %
+                       (op, self.property_name))
+
+    def is_transactional_op(self, op):
+        """Returns True if the given in-place update operation should be
+        applied (along with re-reading and saving the model instance) within
+        a transaction, False otherwise."""
+        return True
+
 
 class DateTimeHandler(PropertyHandler):
     """PropertyHandler for datetime/data/time property instances."""
@@ -799,6 +1302,66 @@ class BooleanHandler(PropertyHandler):
         return ((value == TRUE_VALUE) or (value == TRUE_NUMERIC_VALUE))
 
 
+class ShardedCounterHandler(PropertyHandler):
+    """PropertyHandler for numeric properties declared as sharded counters
+    (see the sharded_counters of Dispatcher.add_model()).  The value of the
+    counter is the sum of its CounterShards, which may only be modified using
+    the 'incr' operation (other incoming values are ignored)."""
+
+    def __init__(self, property_name, property_type, num_shards):
+        super(ShardedCounterHandler, self).__init__(property_name,
+                                                    property_type)
+        self.num_shards = num_shards
+
+    def can_query(self):
+        """Sharded counters may not be used in query filters (the stored
+        property value is not maintained)."""
+        return False
+
+    def get_value(self, model):
+        """Returns the sum of the shards of this counter for the given model
+        instance (using the totals preloaded by
+        ModelHandler.load_counters(), if any)."""
+        if(not model.is_saved()):
+            return 0
+        counters = getattr(model, "disp_counters_", None)
+        if(counters is None):
+            counters = {}
+            model.disp_counters_ = counters
+        if(self.property_name not in counters):
+            counters[self.property_name] = CounterShard.get_total(
+                CounterShard.get_keys(model.key(), self.property_name,
+                                      self.num_shards))
+        return counters[self.property_name]
+
+    def read_xml_value(self, props, prop_el):
+        """Incoming values for sharded counters are ignored."""
+        pass
+
+    def value_from_request(self, dispatcher, model, path):
+        """Sharded counters may only be modified using the 'incr'
+        operation."""
+        raise KeyError("Sharded counter %s may only be incremented" %
+                       self.property_name)
+
+    def apply_op(self, model, op, op_value):
+        """Records an increment of this counter, which is applied to a random
+        shard when the model instance is saved (the model instance itself is
+        not modified)."""
+        counter_deltas = getattr(model, "disp_counter_deltas_", None)
+        if(counter_deltas is None):
+            counter_deltas = {}
+            model.disp_counter_deltas_ = counter_deltas
+        counter_deltas[self.property_name] = (
+            counter_deltas.get(self.property_name, 0) + op_value)
+        model.disp_unchanged_ = True
+
+    def is_transactional_op(self, op):
+        """Shard increments are applied in their own transactions (the model
+        instance is not modified)."""
+        return False
+
+
 class TextHandler(PropertyHandler):
     """PropertyHandler for (large) text property instances."""
 
@@ -809,6 +1372,13 @@ class TextHandler(PropertyHandler):
         """Text properties may not be used in query filters."""
         return False
 
+    def value_to_response(self, dispatcher, prop_xml_name, value, path):
+        """Writes the output of a single property to the dispatcher's
+        response (honoring byte range requests on the utf-8 encoded
+        text)."""
+        dispatcher.set_response_content_type(self.property_content_type)
+        dispatcher.write_ranged_output((value or u"").encode(XML_ENCODING))
+
 
 class ByteStringHandler(PropertyHandler):
     """PropertyHandler for ByteString property instances."""
@@ -832,6 +1402,17 @@ class ByteStringHandler(PropertyHandler):
         """Returns the given string."""
         return value
 
+    def can_prefix_query(self):
+        """Byte string properties may not be used in prefix query
+        filters."""
+        return False
+
+    def value_to_response(self, dispatcher, prop_xml_name, value, path):
+        """Writes the output of a single property to the dispatcher's
+        response (honoring byte range requests)."""
+        dispatcher.set_response_content_type(self.property_content_type)
+        dispatcher.write_ranged_output(value or "")
+
 
 class BlobHandler(ByteStringHandler):
     """PropertyHandler for blob property instances."""
@@ -1028,6 +1609,10 @@ class ListHandler(PropertyHandler):
         """Can query is based on the list element type."""
         return self.sub_handler.can_query()
 
+    def can_prefix_query(self):
+        """Can prefix query is based on the list element type."""
+        return self.sub_handler.can_prefix_query()
+
     def value_for_query(self, value):
         """Returns the value for a query filter based on the list element
         type."""
@@ -1107,7 +1692,18 @@ class ListHandler(PropertyHandler):
                                                item_value, path)
             return
 
-        # return entire list as xml/json
+        # return entire list (or the requested slice) as xml/json
+        start = dispatcher.get_query_param(QUERY_START_PARAM)
+        count = dispatcher.get_query_param(QUERY_COUNT_PARAM)
+        if(value and ((start is not None) or (count is not None))):
+            start = int(start or 0)
+            end = None
+            if(count is not None):
+                end = start + int(count)
+            if((start < 0) or ((end is not None) and (end < start))):
+                raise ValueError("Invalid list slice %s, %s" % (start, count))
+            value = value[start:end]
+
         impl = minidom.getDOMImplementation()
         doc = None
 
@@ -1131,7 +1727,7 @@ class ListHandler(PropertyHandler):
         if(len(path) > 0):
             # set individual list element
             item_value = self.sub_handler.value_from_raw_string(
-                dispatcher.request.body_file.getvalue())
+                dispatcher.get_request_body())
             value = getattr(model, self.property_name)
             item_index = int(path.pop(0))
             if(item_index == len(value)):
@@ -1151,6 +1747,34 @@ class ListHandler(PropertyHandler):
         finally:
             doc.unlink()
 
+    def read_op_value(self, dispatcher, op, path):
+        """Returns the list of items (read from the xml/json list in the
+        dispatcher's request) to 'append' to or 'remove' from this list."""
+        if((op not in LIST_OPS) or (len(path) > 0)):
+            return super(ListHandler, self).read_op_value(dispatcher, op,
+                                                          path)
+        doc = dispatcher.input_to_xml()
+        try:
+            props = {}
+            self.read_xml_value(props, doc.documentElement)
+            return props[self.property_name]
+        finally:
+            doc.unlink()
+
+    def apply_op(self, model, op, op_value):
+        """Appends the given items to this list, or removes all occurrences
+        of the given items from this list."""
+        value = getattr(model, self.property_name)
+        if(op == LIST_OP_APPEND):
+            value.extend(op_value)
+            return
+        try:
+            op_value = frozenset(op_value)
+        except TypeError:
+            # unhashable item type, fall back to list membership
+            pass
+        value[:] = [item for item in value if item not in op_value]
+
 
 # Dynamic Property: "values for query"
 # Coerce basic Python types from strings.
@@ -1167,11 +1791,14 @@ DYN_TIME_RE = re.compile(r"^\d{2}[:]\d{2}[:]\d{2}$")
 
 
 class DynamicPropertyHandler(object):
-    """PropertyHandler for dynamic properties on Expando models."""
+    """PropertyHandler for dynamic properties on Expando models.  The
+    PropertyHandlers for the actual values are created on demand and re-used
+    for later values of the same type."""
 
     def __init__(self, property_name):
         self.property_name = property_name
         self.storage_name = None
+        self.handlers = {}
 
     def get_query_field(self):
         """Returns the field name which should be used to query this
@@ -1184,6 +1811,11 @@ class DynamicPropertyHandler(object):
         """
         return True
 
+    def can_prefix_query(self):
+        """Dynamic properties can be used in prefix query filters (which only
+        match string values)."""
+        return True
+
     def write_xml_value(self, parent_el, prop_xml_name, model,
                         blob_info_format):
         """Returns the property value from the given model instance converted
@@ -1208,6 +1840,12 @@ class DynamicPropertyHandler(object):
 
         props[self.property_name] = get_node_text(prop_el.childNodes)
 
+    def read_op_value(self, dispatcher, op, path):
+        """In-place update operations are not supported on dynamic
+        properties."""
+        raise KeyError("Unsupported operation %s on property %s" %
+                       (op, self.property_name))
+
     def value_for_query(self, value):
         """Returns the value for this property from the given string value
         (may be None), for use in a query filter.  Coerce the string value to
@@ -1241,6 +1879,26 @@ class DynamicPropertyHandler(object):
     def get_handler(self, property_type, value):
         """Returns the relevant PropertyHandler based on the given
         property_type string or property value."""
+        if(value is not None):
+            # keyed by (value type, list item type)
+            handler_key = (type(value), None)
+            if(isinstance(value, list) and value):
+                handler_key = (type(value), type(value[0]))
+        else:
+            handler_key = property_type
+        prop_handler = self.handlers.get(handler_key, None)
+        if prop_handler is None:
+            # shared by concurrent requests, so only populated under the lock
+            with DYNAMIC_HANDLERS_LOCK:
+                prop_handler = self.handlers.get(handler_key, None)
+                if prop_handler is None:
+                    prop_handler = self.create_handler(property_type, value)
+                    self.handlers[handler_key] = prop_handler
+        return prop_handler
+
+    def create_handler(self, property_type, value):
+        """Returns a new PropertyHandler based on the given property_type
+        string or property value."""
         prop_args = []
         sub_handler = None
         if(value is not None):
@@ -1288,6 +1946,11 @@ def get_property_handler(property_name, property_type):
     return PropertyHandler(property_name, property_type)
 
 
+# guards the (lazily populated) handler caches of the ModelHandlers and
+# DynamicPropertyHandlers
+DYNAMIC_HANDLERS_LOCK = threading.Lock()
+
+
 class ModelQuery(object):
     """Utility class for holding parameters for a model query."""
 
@@ -1295,11 +1958,21 @@ class ModelQuery(object):
         self.fetch_page_size = MAX_FETCH_PAGE_SIZE
         self.fetch_offset = None
         self.fetch_cursor = None
-        self.ordering = None
-        self.order_type_idx = QUERY_ORDER_ASC_IDX
+        self.orderings = []
+        self.aggregate_func = None
+        self.aggregate_handler = None
+        self.changes_since = None
+        self.deleted_since = None
         self.query_expr = None
         self.query_params = []
+        self.inequality_field = None
         self.next_fetch_offset = ""
+        self.filters = []
+        self.shape = None
+        self.geo_property = None
+        self.geo_box = None
+        self.geo_near = None
+        self.fetch_time = 0
 
     def parse(self, dispatcher, model_handler):
         """Parses the current request into a query."""
@@ -1319,16 +1992,41 @@ class ModelQuery(object):
                 continue
 
             if(arg == QUERY_ORDERING_PARAM):
-                ordering_field = dispatcher.request.get(QUERY_ORDERING_PARAM)
-                if(ordering_field[0] == "-"):
-                    ordering_field = ordering_field[1:]
-                    self.order_type_idx = QUERY_ORDER_DSC_IDX
-                prop_handler = model_handler.get_property_handler(
-                    ordering_field)
-                if(not prop_handler.can_query()):
-                    raise KeyError("Can not order on property %s" %
-                                   ordering_field)
-                self.ordering = prop_handler.get_query_field()
+                # comma separated list of fields, e.g. "a,-b,c"
+                ordering_fields = dispatcher.request.get(
+                    QUERY_ORDERING_PARAM).split(QUERY_ORDERING_SEPARATOR)
+                for ordering_field in ordering_fields:
+                    ordering_field = ordering_field.strip()
+                    if(not ordering_field):
+                        continue
+                    order_type_idx = QUERY_ORDER_ASC_IDX
+                    if(ordering_field[0] == "-"):
+                        ordering_field = ordering_field[1:]
+                        order_type_idx = QUERY_ORDER_DSC_IDX
+                    prop_handler = model_handler.get_property_handler(
+                        ordering_field)
+                    if(not prop_handler.can_query()):
+                        raise KeyError("Can not order on property %s" %
+                                       ordering_field)
+                    self.orderings.append((prop_handler.get_query_field(),
+                                           order_type_idx))
+                continue
+
+            if(arg == QUERY_AGGREGATE_PARAM):
+                self.parse_aggregate(dispatcher.request.get(arg),
+                                     model_handler)
+                continue
+
+            if(arg == QUERY_CHANGES_SINCE_PARAM):
+                self.changes_since = (
+                    model_handler.get_changes_handler().value_for_query(
+                        dispatcher.request.get(arg)))
+                continue
+
+            if(arg == QUERY_DELETED_SINCE_PARAM):
+                self.deleted_since = (
+                    model_handler.get_changes_handler().value_for_query(
+                        dispatcher.request.get(arg)))
                 continue
 
             if(arg in EXTRA_QUERY_PARAMS):
@@ -1342,6 +2040,31 @@ class ModelQuery(object):
 
             query_type = match.group(1)
             query_field = match.group(2)
+
+            if(query_type in QUERY_GEO_TYPES):
+                self.parse_geo_filter(query_type, query_field,
+                                      dispatcher.request.get(arg),
+                                      model_handler)
+                self.filters.append((query_type, self.geo_property))
+                continue
+
+            if(query_type == QUERY_PREFIX_TYPE):
+                # "starts with" is the range [prefix, prefix + <max char>)
+                prop_handler = model_handler.get_property_handler(
+                    query_field)
+                if(not prop_handler.can_prefix_query()):
+                    raise KeyError("Can not prefix filter on property %s" %
+                                   query_field)
+                query_field = prop_handler.get_query_field()
+                self.set_inequality_field(query_field)
+                self.filters.append((query_type, query_field))
+                for value in dispatcher.request.get_all(arg):
+                    value = unicode(value)
+                    self.add_filter(QUERY_EXPRS["fge_"], query_field, value)
+                    self.add_filter(QUERY_EXPRS["flt_"], query_field,
+                                    value + MAX_UNICODE_CHAR)
+                continue
+
             query_sub_expr = QUERY_EXPRS[query_type]
 
             query_values = dispatcher.request.get_all(arg)
@@ -1351,19 +2074,156 @@ class ModelQuery(object):
             query_field, query_values = model_handler.read_query_values(
                 query_field, query_values)
 
+            if(query_type in QUERY_INEQUALITY_TYPES):
+                self.set_inequality_field(query_field)
+            self.filters.append((query_type, query_field))
+
             for value in query_values:
-                self.query_params.append(value)
-                query_sub_expr = query_sub_expr % (query_field,
-                                                   len(self.query_params))
-                if(not self.query_expr):
-                    self.query_expr = QUERY_PREFIX + query_sub_expr
-                else:
-                    self.query_expr += QUERY_JOIN + query_sub_expr
+                self.add_filter(query_sub_expr, query_field, value)
+
+        if((self.geo_property is not None) and
+           (self.query_expr or self.orderings or self.aggregate_func or
+            (self.fetch_cursor and self.geo_near) or
+            (self.changes_since is not None) or
+            (self.deleted_since is not None))):
+            raise KeyError("Can not combine geo filters with other filters, "
+                           "orderings or cursors")
+
+        if(((self.changes_since is not None) or
+            (self.deleted_since is not None)) and
+           (self.fetch_offset is not None)):
+            # timestamps in a change feed may tie, so change queries are only
+            # resumed from the returned cursor (never from a timestamp)
+            raise KeyError("Change queries can only be resumed using the "
+                           "returned cursor offset")
+
+        if(self.changes_since is not None):
+            # changes are always returned in update order
+            changes_field = model_handler.get_changes_handler(
+                ).get_query_field()
+            changes_ordering = (changes_field, QUERY_ORDER_ASC_IDX)
+            if(self.orderings and (self.orderings != [changes_ordering])):
+                raise KeyError("Can not order changes on other properties")
+            self.orderings = [changes_ordering]
+            self.set_inequality_field(changes_field)
+            self.filters.append(("fgt_", changes_field))
+            self.add_filter(QUERY_EXPRS["fgt_"], changes_field,
+                            self.changes_since)
+
+        # the datastore requires that the first sort order (if any) is on
+        # the inequality filter property
+        if(self.inequality_field and self.orderings and
+           (self.orderings[0][0] != self.inequality_field)):
+            raise KeyError("First ordering must be on property %s" %
+                           self.inequality_field)
 
         self.fetch_page_size = max(min(dispatcher.fetch_page_size,
                                        self.fetch_page_size,
                                        MAX_FETCH_PAGE_SIZE), 1)
 
+    def add_filter(self, query_sub_expr, query_field, value):
+        """Adds a filter expression (like '%s = :%d') for the given query
+        field and value to the query."""
+        self.query_params.append(value)
+        query_sub_expr = query_sub_expr % (query_field,
+                                           len(self.query_params))
+        if(not self.query_expr):
+            self.query_expr = QUERY_PREFIX + query_sub_expr
+        else:
+            self.query_expr += QUERY_JOIN + query_sub_expr
+
+    def set_inequality_field(self, query_field):
+        """Records the field used by an inequality filter (the datastore
+        only supports inequality filters on a single property)."""
+        if(self.inequality_field and (self.inequality_field != query_field)):
+            raise KeyError("Can not use inequality filters on properties "
+                           "%s and %s" % (self.inequality_field, query_field))
+        self.inequality_field = query_field
+
+    def get_shape(self, model_handler):
+        """Returns a tuple describing the 'shape' of this query (the model,
+        filter fields/types, orderings and page size, but not the filter
+        values), used for gathering query statistics."""
+        return (model_handler.model_name, model_handler.model_type.kind(),
+                tuple(sorted(set(self.filters))), tuple(self.orderings),
+                self.inequality_field, self.fetch_page_size)
+
+    def parse_geo_filter(self, query_type, prop_name, value, model_handler):
+        """Parses a bounding box ('fbbox_<property>=<south>,<west>,<north>,
+        <east>') or proximity ('fnear_<property>=<lat>,<lon>,<radius km>')
+        filter on a geo indexed property."""
+        prop_handler = model_handler.get_property_handler(prop_name)
+        if(prop_handler.property_name not in model_handler.geo_properties):
+            raise KeyError("Can not geo filter on property %s" % prop_name)
+        if(self.geo_property is not None):
+            raise KeyError("Can not use multiple geo filters")
+
+        coords = [float(coord) for coord in value.split(QUERY_GEO_SEPARATOR)]
+        if(query_type == QUERY_BBOX_TYPE):
+            if(len(coords) != 4):
+                raise ValueError("Invalid bounding box %s" % value)
+            south, west, north, east = coords
+            check_geo_point(south, west)
+            check_geo_point(north, east)
+            if(south > north):
+                raise ValueError("Invalid bounding box %s" % value)
+            self.geo_box = (south, west, north, east)
+        else:
+            if(len(coords) != 3):
+                raise ValueError("Invalid proximity filter %s" % value)
+            lat, lon, radius = coords
+            check_geo_point(lat, lon)
+            if(radius <= 0):
+                raise ValueError("Invalid radius %s" % radius)
+            self.geo_near = (lat, lon, radius)
+            self.geo_box = get_near_box(lat, lon, radius)
+        self.geo_property = prop_handler.property_name
+
+    def parse_aggregate(self, aggregate, model_handler):
+        """Parses an aggregate function param like 'count' or
+        'sum:<property>'."""
+        func, _, prop_name = aggregate.partition(AGGREGATE_SEPARATOR)
+        if(func not in AGGREGATE_FUNCS):
+            raise KeyError("Unknown aggregate function %s" % func)
+        self.aggregate_func = func
+        if(func == AGGREGATE_COUNT):
+            return
+
+        # other aggregates work on projections of a declared property
+        prop_handler = model_handler.property_handlers.get(prop_name, None)
+        if((prop_handler is None) or (not prop_handler.can_query())):
+            raise KeyError("Can not aggregate property %s" % prop_name)
+        if((func == AGGREGATE_SUM) and
+           (not issubclass(prop_handler.get_data_type(), (int, long, float)))):
+            raise KeyError("Can not sum property %s" % prop_name)
+        self.aggregate_handler = prop_handler
+
+
+# parsed (never run) GqlQuery instances keyed by (model type, namespace,
+# query expression)
+COMPILED_QUERIES = {}
+
+
+def get_gql_query(model_type, query_expr, query_params,
+                  select=GQL_SELECT_ALL):
+    """Returns a GqlQuery for the given model type and query expression bound
+    to the given positional params (optionally selecting only the keys or
+    the given projection).  The query expression is only parsed the first
+    time it is seen, later queries re-bind a copy of the parsed query."""
+    cache_key = (model_type, namespace_manager.get_namespace(), select,
+                 query_expr)
+    compiled_query = COMPILED_QUERIES.get(cache_key, None)
+    if compiled_query is None:
+        compiled_query = db.GqlQuery(GQL_QUERY_FORMAT % (
+            select, model_type.kind(), query_expr))
+        if(len(COMPILED_QUERIES) >= MAX_COMPILED_QUERIES):
+            COMPILED_QUERIES.clear()
+        COMPILED_QUERIES[cache_key] = compiled_query
+
+    query = copy.copy(compiled_query)
+    query.bind(*query_params)
+    return query
+
 
 class Lazy(object):
     """Utility class for enabling lazy initialization of decorated
@@ -1380,22 +2240,56 @@ class Lazy(object):
         return value
 
 
+class FrozenDict(dict):
+    """Simple immutable dict."""
+
+    def _immutable(self, *_, **__):
+        raise TypeError("%s is immutable" % self.__class__.__name__)
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+
 class ModelHandler(object):
     """Handler for a Model (or Expando) type which manages converting
     instances to and from xml."""
 
-    def __init__(self, model_name, model_type, model_methods):
+    # sharded counters (dict of property name to number of shards) of each
+    # model kind, folded into the hashes (etags) of the model instances
+    kind_counters = {}
+
+    def __init__(self, model_name, model_type, model_methods,
+                 changes_property=None, geo_properties=None,
+                 sharded_counters=None):
         self.model_name = model_name
         self.model_type = model_type
         self.key_handler = KeyHandler()
         self.model_methods = model_methods
+        self.changes_property = changes_property
+        self.geo_properties = frozenset(geo_properties or ())
+        self.sharded_counters = dict(sharded_counters or {})
+        self.dynamic_handlers = {}
+
+    def freeze(self):
+        """Eagerly initializes the lazy state of this handler and makes it
+        immutable (see Dispatcher.freeze_model_handlers())."""
+        self.property_handlers = FrozenDict(self.property_handlers)
 
     @Lazy
     def property_handlers(self):
         """Lazy initializer for the property_handlers dict."""
         prop_handlers = {}
         for prop_name, prop_type in self.model_type.properties().iteritems():
-            prop_handler = get_property_handler(prop_name, prop_type)
+            if(prop_name in self.sharded_counters):
+                prop_handler = ShardedCounterHandler(
+                    prop_name, prop_type, self.sharded_counters[prop_name])
+            else:
+                prop_handler = get_property_handler(prop_name, prop_type)
             prop_xml_name = convert_to_valid_xml_name(
                 prop_handler.property_name)
             prop_handlers[prop_xml_name] = prop_handler
@@ -1412,15 +2306,274 @@ class ModelHandler(object):
         if model and Dispatcher.enable_etags:
             # compute pristine hash before any modifications are made
             self.hash_model(model)
+            self.cache_etag(model)
         return model
 
+    def get_multi(self, keys):
+        """Returns the model instances with the given keys (None for missing
+        instances), fetched with a single batch get."""
+        models = self.model_type.get(keys)
+        if Dispatcher.enable_etags:
+            # compute pristine hashes before any modifications are made
+            found_models = [model for model in models if model]
+            self.hash_models(found_models)
+            for model in found_models:
+                self.cache_etag(model)
+        return models
+
     @classmethod
     def put(cls, model):
-        """Saves a new/updated model instance."""
-        model.put()
-        if Dispatcher.enable_etags:
-            # compute the new etag for the modified instance
-            cls.hash_model(model, True)
+        """Saves a new/updated model instance (unless marked as unchanged),
+        and applies any pending sharded counter increments, using the model
+        handler registered for the type of the model (if any, so that its
+        geo index entries are maintained), see put_multi()."""
+        for model_handler in Dispatcher.model_handlers.itervalues():
+            if(model_handler.model_type is type(model)):
+                break
+        else:
+            model_handler = cls(model.kind(), type(model), ())
+        model_handler.put_multi([model])
+
+    def put_multi(self, models):
+        """Saves the given new/updated model instances (except those marked
+        as unchanged) in a single batch, and applies any pending sharded
+        counter increments."""
+        self.write_multi(models)
+        self.finish_put(models)
+
+    def write_multi(self, models):
+        """Writes the given new/updated model instances (except those marked
+        as unchanged) and their geo index entries to the datastore, and
+        removes the tombstones of re-created instances (both are in the same
+        entity group).  Only does datastore writes (no memcache updates), so
+        may be called within a transaction (followed by finish_put() after
+        the commit)."""
+        changed_models = [model for model in models
+                          if not getattr(model, "disp_unchanged_", False)]
+        new_models = [model for model in changed_models
+                      if not model.is_saved()]
+        if changed_models:
+            db.put(changed_models)
+        if(self.changes_property and new_models):
+            # a new instance may re-use the key of a deleted instance
+            db.delete([ModelTombstone.get_key(model.key())
+                       for model in new_models])
+        if self.geo_properties:
+            for model in changed_models:
+                self.put_geo_index(model)
+
+    def finish_put(self, models):
+        """Updates the cached etags and write generations for the given
+        model instances (written by write_multi()), and applies any pending
+        sharded counter increments.  Must not be called within a
+        transaction."""
+        changed_models = [model for model in models
+                          if not getattr(model, "disp_unchanged_", False)]
+        model_namespaces = set()
+        for model in changed_models:
+            if Dispatcher.enable_etags:
+                # compute the new etag for the modified instance
+                self.hash_model(model, True)
+                self.cache_etag(model)
+            model_namespaces.add(model.key().namespace())
+        if Dispatcher.aggregate_cache_time:
+            for model_ns in model_namespaces:
+                self.increment_write_generation(self.model_type.kind(),
+                                                model_ns)
+
+        for model in models:
+            counter_deltas = getattr(model, "disp_counter_deltas_", None)
+            if(not counter_deltas):
+                continue
+            model.disp_counter_deltas_ = None
+            model.disp_counters_ = None
+            model.disp_unchanged_ = False
+            for prop_name, delta in counter_deltas.iteritems():
+                shard_keys = CounterShard.get_keys(
+                    model.key(), prop_name, self.sharded_counters[prop_name])
+                CounterShard.increment(random.choice(shard_keys), delta)
+            if Dispatcher.enable_etags:
+                # the counter totals are part of the etag, so the cached etag
+                # is dropped (concurrent increments may finish in any order)
+                self.hash_model(model, True)
+                if Dispatcher.enable_etag_cache:
+                    memcache.delete(ETAG_CACHE_PREFIX + str(model.key()),
+                                    namespace=CACHE_NAMESPACE)
+
+    def get_model_state(self, model):
+        """Returns a snapshot of the state of the given model instance which
+        would be written to the datastore (ignoring auto_now properties),
+        used to detect unchanged model instances.  Values are recorded with
+        their types, as values of different types may compare equal (e.g.
+        1, 1.0 and True) but are stored differently."""
+        state = {}
+        for prop_name, prop_type in model.properties().iteritems():
+            if getattr(prop_type, "auto_now", False):
+                continue
+            state[prop_name] = get_typed_state(
+                prop_type.get_value_for_datastore(model))
+        for prop_name in model.dynamic_properties():
+            state[prop_name] = get_typed_state(getattr(model, prop_name))
+        return state
+
+    def check_unchanged(self, model, state):
+        """Marks the given model instance as unchanged (so that put() will
+        skip the datastore write) if its current state matches the given
+        snapshot (see get_model_state())."""
+        if(self.get_model_state(model) == state):
+            model.disp_unchanged_ = True
+
+    @classmethod
+    def load_counters(cls, models):
+        """Loads the totals of the sharded counters of the given (saved)
+        model instances in batches."""
+        models = [model for model in models
+                  if (model and model.is_saved() and
+                      (model.kind() in cls.kind_counters) and
+                      (getattr(model, "disp_counters_", None) is None))]
+        shard_keys = []
+        for model in models:
+            counters = sorted(cls.kind_counters[model.kind()].iteritems())
+            for prop_name, num_shards in counters:
+                shard_keys.extend(CounterShard.get_keys(model.key(),
+                                                        prop_name, num_shards))
+        shards = iter(CounterShard.get_shards(shard_keys))
+        for model in models:
+            model.disp_counters_ = {}
+            counters = sorted(cls.kind_counters[model.kind()].iteritems())
+            for prop_name, num_shards in counters:
+                total = 0
+                for _ in xrange(num_shards):
+                    shard = shards.next()
+                    if shard:
+                        total += shard.value
+                model.disp_counters_[prop_name] = total
+
+    def put_geo_index(self, model):
+        """Updates the GeoIndex entries for the geo indexed properties of the
+        given (saved) model instance.  Note, the entries are not updated in
+        the same transaction as the model instance."""
+        index_entries = []
+        stale_keys = []
+        for prop_name in self.geo_properties:
+            geo_pt = getattr(model, prop_name)
+            index_key = GeoIndex.get_key(model.key(), prop_name)
+            if(geo_pt is None):
+                stale_keys.append(index_key)
+            else:
+                index_entries.append(GeoIndex(
+                    key=index_key,
+                    geo_cell=GeoIndex.get_geo_cell(
+                        model.kind(), prop_name,
+                        geohash_encode(geo_pt.lat, geo_pt.lon))))
+        if index_entries:
+            db.put(index_entries)
+        if stale_keys:
+            db.delete(stale_keys)
+
+    def delete(self, model_keys):
+        """Deletes the model instances with the given keys."""
+        # the geo index entries and counter shards (if any) are deleted in the
+        # same call, so that a re-created instance starts from scratch
+        db.delete(list(model_keys) +
+                  [GeoIndex.get_key(model_key, prop_name)
+                   for model_key in model_keys
+                   for prop_name in self.geo_properties] +
+                  [shard_key
+                   for model_key in model_keys
+                   for prop_name, num_shards in self.sharded_counters.items()
+                   for shard_key in CounterShard.get_keys(model_key, prop_name,
+                                                          num_shards)])
+        if Dispatcher.enable_etag_cache:
+            memcache.delete_multi([str(model_key) for model_key in model_keys],
+                                  key_prefix=ETAG_CACHE_PREFIX,
+                                  namespace=CACHE_NAMESPACE)
+        if(Dispatcher.aggregate_cache_time and model_keys):
+            self.increment_write_generation(self.model_type.kind(),
+                                            model_keys[0].namespace())
+        if(self.changes_property and model_keys):
+            deleted = datetime.now()
+            db.put([ModelTombstone.create(model_key, deleted)
+                    for model_key in model_keys])
+
+    def get_changes_handler(self):
+        """Returns the property handler for the change feed property of this
+        Model type, raises KeyError if this type does not have a change
+        feed."""
+        if(not self.changes_property):
+            raise KeyError("Model %s does not support change queries" %
+                           self.model_name)
+        return self.property_handlers[convert_to_valid_xml_name(
+            self.changes_property)]
+
+    def get_deleted(self, model_query):
+        """Returns the tombstones of the model instances of this type deleted
+        after the deleted_since time of the given query (in deletion
+        order)."""
+        kind = self.model_type.kind()
+        query = ModelTombstone.all()
+        query.filter("feed_position >", ModelTombstone.get_feed_position(
+            kind, model_query.deleted_since))
+        query.filter("feed_position <", kind + TOMBSTONE_POSITION_SEP +
+                     MAX_UNICODE_CHAR)
+        query.order("feed_position")
+
+        if model_query.fetch_cursor:
+            query.with_cursor(model_query.fetch_cursor)
+
+        tombstones = query.fetch(model_query.fetch_page_size)
+
+        # the cursor is always returned, as it is the only way to resume the
+        # feed (later deletes are found after the cursor)
+        model_query.next_fetch_offset = (QUERY_CURSOR_PREFIX +
+                                         query.cursor())
+
+        return tombstones
+
+    def prune_tombstones(self, max_age):
+        """Deletes (in batches) the tombstones of the model instances of this
+        type which were deleted more than max_age seconds ago.  Returns the
+        number of deleted tombstones."""
+        kind = self.model_type.kind()
+        query = ModelTombstone.all(keys_only=True)
+        query.filter("feed_position >=", kind + TOMBSTONE_POSITION_SEP)
+        query.filter("feed_position <", ModelTombstone.get_feed_position(
+            kind, datetime.now() - timedelta(seconds=max_age)))
+        num_pruned = 0
+        while True:
+            tombstone_keys = query.fetch(MAX_FETCH_PAGE_SIZE)
+            if(not tombstone_keys):
+                break
+            db.delete(tombstone_keys)
+            num_pruned += len(tombstone_keys)
+            if(len(tombstone_keys) < MAX_FETCH_PAGE_SIZE):
+                break
+        return num_pruned
+
+    @classmethod
+    def increment_write_generation(cls, model_kind, model_ns):
+        """Increments the counter of writes made to models of the given kind
+        in the given namespace (invalidating cached aggregates)."""
+        memcache.incr(WRITE_GENERATION_PREFIX + model_ns + ":" + model_kind,
+                      initial_value=get_initial_write_generation(),
+                      namespace=CACHE_NAMESPACE)
+
+    def get_write_generation(self):
+        """Returns the counter of writes made to models of this type in the
+        current namespace (starting a new counter if there is none)."""
+        generation_key = (WRITE_GENERATION_PREFIX +
+                          namespace_manager.get_namespace() + ":" +
+                          self.model_type.kind())
+        generation = memcache.get(generation_key, namespace=CACHE_NAMESPACE)
+        if(generation is None):
+            memcache.add(generation_key, get_initial_write_generation(),
+                         namespace=CACHE_NAMESPACE)
+            generation = memcache.get(generation_key,
+                                      namespace=CACHE_NAMESPACE)
+        if(generation is None):
+            # memcache unavailable, nothing can be cached safely
+            return None
+        return generation
 
     def create(self, props):
         """Returns a newly created model instance with the given properties
@@ -1441,26 +2594,19 @@ class ModelHandler(object):
         """Returns all model instances of this type matching the given
         query."""
 
-        if model_query.fetch_offset is not None:
-            # if possible, attempt to fetch more than we really want so that
-            # we can determine if we have more results.  this trick is only
-            # possible if fetching w/ offsets
-            real_fetch_page_size = model_query.fetch_page_size
-            if(model_query.fetch_page_size < MAX_FETCH_PAGE_SIZE):
-                model_query.fetch_page_size += 1
+        if(model_query.geo_property is not None):
+            return self.get_all_geo(model_query)
 
-        if(model_query.query_expr is None):
-            query = self.model_type.all()
-            if(model_query.ordering):
-                query.order(QUERY_ORDER_PREFIXES[model_query.order_type_idx] +
-                            model_query.ordering)
-        else:
-            if(model_query.ordering):
-                model_query.query_expr += (
-                    QUERY_ORDERBY + model_query.ordering +
-                    QUERY_ORDER_SUFFIXES[model_query.order_type_idx])
-            query = self.model_type.gql(model_query.query_expr,
-                                        *model_query.query_params)
+        # when enabled, the cursor at the end of each page is remembered so
+        # that a later request for the next numeric offset can use it
+        # instead of having the datastore skip all the preceding entities
+        offset_cursor_key = None
+        if(Dispatcher.enable_offset_cursors and
+           (model_query.fetch_cursor is None)):
+            offset_cursor_key = (OFFSET_CURSOR_CACHE_PREFIX +
+                                 self.get_query_digest(model_query) + ":")
+
+        query = self.build_query(model_query)
 
         if model_query.fetch_offset is None:
             if model_query.fetch_cursor:
@@ -1468,16 +2614,53 @@ class ModelHandler(object):
 
             models = query.fetch(model_query.fetch_page_size)
 
-            if(len(models) == model_query.fetch_page_size):
+            # change queries always return a cursor, as it is the only way to
+            # resume the feed (later changes are found after the cursor)
+            is_full = (len(models) == model_query.fetch_page_size)
+            if(is_full or (model_query.changes_since is not None)):
                 try:
+                    cursor = query.cursor()
                     model_query.next_fetch_offset = (QUERY_CURSOR_PREFIX +
-                                                     query.cursor())
+                                                     cursor)
+                    if(offset_cursor_key and is_full):
+                        memcache.set(offset_cursor_key +
+                                     str(model_query.fetch_page_size),
+                                     cursor, Dispatcher.cache_time)
                 except AssertionError:
                     # some queries don't allow cursors, fallback to offsets
-                    model_query.next_fetch_offset = str(
-                        model_query.fetch_page_size)
+                    if is_full:
+                        model_query.next_fetch_offset = str(
+                            model_query.fetch_page_size)
+
+        elif offset_cursor_key:
+            cursor = memcache.get(offset_cursor_key +
+                                  str(model_query.fetch_offset))
+            if cursor:
+                query.with_cursor(cursor)
+                models = query.fetch(model_query.fetch_page_size)
+            else:
+                models = query.fetch(model_query.fetch_page_size,
+                                     model_query.fetch_offset)
+
+            if(len(models) == model_query.fetch_page_size):
+                next_fetch_offset = (model_query.fetch_offset +
+                                     model_query.fetch_page_size)
+                model_query.next_fetch_offset = str(next_fetch_offset)
+                try:
+                    memcache.set(offset_cursor_key + str(next_fetch_offset),
+                                 query.cursor(), Dispatcher.cache_time)
+                except AssertionError:
+                    # some queries don't allow cursors
+                    pass
 
         else:
+            # if possible, attempt to fetch more than we really want so that
+            # we can determine if we have more results.  this trick is only
+            # possible if fetching w/ offsets
+            real_fetch_page_size = model_query.fetch_page_size
+            if(model_query.fetch_page_size < MAX_FETCH_PAGE_SIZE):
+                model_query.fetch_page_size += 1
+
             models = query.fetch(model_query.fetch_page_size,
                                  model_query.fetch_offset)
 
@@ -1491,16 +2674,281 @@ class ModelHandler(object):
 
         return models
 
+    def get_all_geo(self, model_query):
+        """Returns the model instances of this type matching the geo filter
+        of the given query (see get_all_bbox() and get_all_near()).
+        Candidates are found using keys only range scans of the GeoIndex
+        entries in the geohash cells covering a bounding box, and are then
+        filtered on their exact location."""
+        if model_query.geo_near:
+            return self.get_all_near(model_query)
+        return self.get_all_bbox(model_query)
+
+    def get_all_bbox(self, model_query):
+        """Returns the model instances of this type within the bounding box
+        of the given query, ordered by geohash.  The covering cells are
+        scanned in order, fetching only the index entries needed for the
+        requested page (at most MAX_GEO_CANDIDATES, so a page may be short),
+        and the next page is resumed from the returned cursor offset."""
+        prop_name = model_query.geo_property
+        geo_cells = self.get_geo_cells(prop_name, model_query.geo_box)
+
+        cell_idx = 0
+        cell_cursor = None
+        if model_query.fetch_cursor:
+            cell_idx, _, cell_cursor = model_query.fetch_cursor.partition(
+                GEO_CURSOR_SEP)
+            cell_idx = int(cell_idx)
+            if((cell_idx < 0) or (cell_idx >= len(geo_cells))):
+                raise ValueError("Invalid geo cursor %s" %
+                                 model_query.fetch_cursor)
+
+        num_skip = model_query.fetch_offset or 0
+        num_needed = model_query.fetch_page_size
+        num_scanned = 0
+        results = []
+        while((cell_idx < len(geo_cells)) and (num_needed > 0) and
+              (num_scanned < MAX_GEO_CANDIDATES)):
+            query = self.get_geo_cell_query(geo_cells[cell_idx])
+            if cell_cursor:
+                query.with_cursor(cell_cursor)
+            limit = min(num_skip + num_needed,
+                        MAX_GEO_CANDIDATES - num_scanned)
+            index_keys = query.fetch(limit)
+            num_scanned += len(index_keys)
+            if(len(index_keys) < limit):
+                # cell is exhausted
+                cell_idx += 1
+                cell_cursor = None
+            else:
+                cell_cursor = query.cursor()
+
+            for model, _ in self.get_geo_matches(
+                [index_key.parent() for index_key in index_keys], prop_name,
+                model_query.geo_box):
+                if(num_skip > 0):
+                    num_skip -= 1
+                else:
+                    results.append(model)
+                    num_needed -= 1
+
+        if(cell_idx < len(geo_cells)):
+            model_query.next_fetch_offset = (
+                QUERY_CURSOR_PREFIX + str(cell_idx) + GEO_CURSOR_SEP +
+                (cell_cursor or ""))
+        return results
+
+    def get_all_near(self, model_query):
+        """Returns the model instances of this type within the radius of the
+        given proximity query, ordered by distance.  Growing rings (see
+        GEO_RING_SCALE) are scanned until a ring contains all the results up
+        to the end of the requested page (so that no closer model can be
+        missed), or the full radius is reached.  If a ring has more than
+        MAX_GEO_CANDIDATES candidates, only the candidates found are used
+        (so very dense areas return approximate results)."""
+        prop_name = model_query.geo_property
+        lat, lon, radius = model_query.geo_near
+        fetch_offset = model_query.fetch_offset or 0
+        fetch_end = fetch_offset + model_query.fetch_page_size
+
+        models = {}
+        ring_radius = radius / GEO_RING_SCALE
+        while True:
+            model_keys = set()
+            for geo_cell in self.get_geo_cells(
+                prop_name, get_near_box(lat, lon, ring_radius)):
+                query = self.get_geo_cell_query(geo_cell)
+                model_keys.update([index_key.parent() for index_key in
+                                   query.fetch(MAX_GEO_CANDIDATES -
+                                               len(model_keys) + 1)])
+                if(len(model_keys) > MAX_GEO_CANDIDATES):
+                    break
+            is_truncated = (len(model_keys) > MAX_GEO_CANDIDATES)
+
+            # models found in smaller rings are not fetched again
+            new_keys = sorted([model_key for model_key in model_keys
+                               if model_key not in models])
+            models.update(self.get_geo_matches(new_keys, prop_name, None,
+                                               True))
+
+            results = []
+            for model_key in model_keys:
+                match = models.get(model_key)
+                if(match is None):
+                    continue
+                model, geo_pt = match
+                distance = geo_distance(lat, lon, geo_pt.lat, geo_pt.lon)
+                if(distance <= ring_radius):
+                    results.append((distance, model_key, model))
+            results.sort()
+
+            if is_truncated:
+                logging.warning("geo query on %s has too many candidates "
+                                "within %s km, results are approximate",
+                                prop_name, ring_radius)
+                break
+            if((len(results) > fetch_end) or (ring_radius >= radius)):
+                break
+            ring_radius = min(ring_radius * 2, radius)
+
+        if(len(results) > fetch_end):
+            model_query.next_fetch_offset = str(fetch_end)
+        return [model for _, _, model in results[fetch_offset:fetch_end]]
+
+    def get_geo_cells(self, prop_name, geo_box):
+        """Returns the (sorted) geo_cells of the geohash cells covering the
+        given bounding box for the given geo indexed property."""
+        return [GeoIndex.get_geo_cell(self.model_type.kind(), prop_name,
+                                      geohash)
+                for box in get_geo_boxes(*geo_box)
+                for geohash in geohash_cover(*box)]
+
+    def get_geo_cell_query(self, geo_cell):
+        """Returns a keys only query of the GeoIndex entries in the given geo
+        cell."""
+        query = GeoIndex.all(keys_only=True)
+        query.filter("geo_cell >=", geo_cell)
+        query.filter("geo_cell <", geo_cell + MAX_UNICODE_CHAR)
+        return query
+
+    def get_geo_matches(self, model_keys, prop_name, geo_box, keyed=False):
+        """Fetches the model instances with the given keys (in batches) and
+        returns a list of (model, location) tuples (in key order) for those
+        whose location is within the given bounding box (if any), or a list
+        of (model key, (model, location)) tuples if keyed is True."""
+        matches = []
+        for i in xrange(0, len(model_keys), MAX_FETCH_PAGE_SIZE):
+            for model in db.get(model_keys[i:i + MAX_FETCH_PAGE_SIZE]):
+                if(model is None):
+                    # index entry is out of date
+                    continue
+                geo_pt = getattr(model, prop_name)
+                if((geo_pt is None) or
+                   ((geo_box is not None) and
+                    (not is_in_geo_box(geo_box, geo_pt.lat, geo_pt.lon)))):
+                    continue
+                if keyed:
+                    matches.append((model.key(), (model, geo_pt)))
+                else:
+                    matches.append((model, geo_pt))
+        return matches
+
+    def get_query_digest(self, model_query):
+        """Returns a digest string which identifies the given query (filters,
+        ordering and parameters) for models of this type."""
+        digest = hashlib.md5()
+        for value in (self.model_type.kind(),
+                      namespace_manager.get_namespace(),
+                      model_query.query_expr, model_query.orderings,
+                      model_query.query_params):
+            digest_value(digest, value)
+        return digest.hexdigest()
+
+    def aggregate(self, model_query):
+        """Returns the result of the aggregate function of the given query
+        over all matching model instances of this type (using keys only or
+        projection queries, fetched in batches).  The result is cached if
+        aggregate_cache_time is configured."""
+        func = model_query.aggregate_func
+        prop_handler = model_query.aggregate_handler
+
+        cache_key = None
+        write_generation = None
+        if Dispatcher.aggregate_cache_time:
+            write_generation = self.get_write_generation()
+        if(write_generation is not None):
+            cache_key = "%s%d:%s:%s" % (
+                AGGREGATE_CACHE_PREFIX, write_generation,
+                self.get_query_digest(model_query), func)
+            if prop_handler:
+                cache_key += ":" + prop_handler.get_query_field()
+            result = memcache.get(cache_key, namespace=CACHE_NAMESPACE)
+            if result is not None:
+                return result[0]
+
+        if(func == AGGREGATE_COUNT):
+            query = self.build_query(model_query, False, GQL_SELECT_KEYS)
+        else:
+            query = self.build_query(model_query, False,
+                                     prop_handler.get_query_field())
+
+        result = None
+        if(func in (AGGREGATE_COUNT, AGGREGATE_SUM)):
+            result = 0
+        fetch_offset = None
+        while True:
+            if fetch_offset is None:
+                results = query.fetch(MAX_FETCH_PAGE_SIZE)
+            else:
+                results = query.fetch(MAX_FETCH_PAGE_SIZE, fetch_offset)
+            if(func == AGGREGATE_COUNT):
+                result += len(results)
+            else:
+                for value in [prop_handler.get_value(model)
+                              for model in results]:
+                    if value is None:
+                        continue
+                    if(func == AGGREGATE_SUM):
+                        result += value
+                    elif((result is None) or
+                         ((func == AGGREGATE_MIN) and (value < result)) or
+                         ((func == AGGREGATE_MAX) and (value > result))):
+                        result = value
+            if(len(results) < MAX_FETCH_PAGE_SIZE):
+                break
+            if fetch_offset is None:
+                try:
+                    query.with_cursor(query.cursor())
+                    continue
+                except AssertionError:
+                    # some queries (IN, !=) don't allow cursors, fallback to
+                    # offsets
+                    fetch_offset = 0
+            fetch_offset += MAX_FETCH_PAGE_SIZE
+
+        if cache_key:
+            # wrap the result so that a cached None is distinguishable from
+            # a cache miss
+            memcache.set(cache_key, (result,),
+                         Dispatcher.aggregate_cache_time,
+                         namespace=CACHE_NAMESPACE)
+
+        return result
+
+    def build_query(self, model_query, include_ordering=True,
+                    select=GQL_SELECT_ALL):
+        """Returns a query for the model instances of this type matching the
+        given query (optionally selecting only the keys or the given
+        projection)."""
+        if(model_query.geo_property is not None):
+            raise KeyError("Geo filters are only supported by get queries")
+        if(model_query.query_expr is None):
+            if(select == GQL_SELECT_KEYS):
+                query = self.model_type.all(keys_only=True)
+            elif(select != GQL_SELECT_ALL):
+                query = self.model_type.all(projection=(select,))
+            else:
+                query = self.model_type.all()
+            if include_ordering:
+                for ordering, order_type_idx in model_query.orderings:
+                    query.order(QUERY_ORDER_PREFIXES[order_type_idx] +
+                                ordering)
+            return query
+
+        query_expr = model_query.query_expr
+        if(include_ordering and model_query.orderings):
+            query_expr += QUERY_ORDERBY + QUERY_ORDER_JOIN.join(
+                [ordering + QUERY_ORDER_SUFFIXES[order_type_idx]
+                 for ordering, order_type_idx in model_query.orderings])
+        return get_gql_query(self.model_type, query_expr,
+                             model_query.query_params, select)
+
     def delete_all(self, model_query):
         """Deletes all model instances of this type matching the given
         query."""
-        if(model_query.query_expr is None):
-            query = self.model_type.all()
-        else:
-            query = self.model_type.gql(model_query.query_expr,
-                                        *model_query.query_params)
+        query = self.build_query(model_query, False, GQL_SELECT_KEYS)
 
-        db.delete(query)
+        self.delete(list(query))
 
     def get_property_handler(self, prop_name):
         """Returns the relevant property handler for the given property
@@ -1511,10 +2959,25 @@ class ModelHandler(object):
         elif(prop_name in self.property_handlers):
             return self.property_handlers[prop_name]
         elif(self.is_dynamic()):
-            return DynamicPropertyHandler(prop_name)
+            return self.get_dynamic_handler(prop_name)
         else:
             raise KeyError("Unknown property %s" % prop_name)
 
+    def get_dynamic_handler(self, prop_name):
+        """Returns the (shared) DynamicPropertyHandler for the dynamic
+        property with the given name."""
+        prop_handler = self.dynamic_handlers.get(prop_name, None)
+        if prop_handler is None:
+            # shared by concurrent requests, so only modified under the lock
+            with DYNAMIC_HANDLERS_LOCK:
+                prop_handler = self.dynamic_handlers.get(prop_name, None)
+                if prop_handler is None:
+                    prop_handler = DynamicPropertyHandler(prop_name)
+                    if(len(self.dynamic_handlers) >= MAX_DYNAMIC_HANDLERS):
+                        self.dynamic_handlers.clear()
+                    self.dynamic_handlers[prop_name] = prop_handler
+        return prop_handler
+
     def read_xml_value(self, model_el):
         """Returns a property dictionary for this Model from the given model
         element."""
@@ -1574,6 +3037,9 @@ class ModelHandler(object):
             model_el.attributes[ETAG_ATTR_NAME] = model_hash_to_str(
                 self.hash_model(model))
 
+        if getattr(model, "disp_unchanged_", False):
+            model_el.attributes[UNCHANGED_ATTR_NAME] = TRUE_VALUE
+
         # write key property first
         if((include_props is None) or (KEY_PROPERTY_NAME in include_props)):
             self.write_xml_property(model_el, model, KEY_PROPERTY_NAME,
@@ -1590,7 +3056,7 @@ class ModelHandler(object):
             prop_xml_name = convert_to_valid_xml_name(prop_name)
             if((include_props is None) or (prop_xml_name in include_props)):
                 self.write_xml_property(model_el, model, prop_xml_name,
-                                        DynamicPropertyHandler(prop_name),
+                                        self.get_dynamic_handler(prop_name),
                                         blob_info_format)
 
     def write_xml_property(self, model_el, model, prop_xml_name, prop_handler,
@@ -1639,8 +3105,61 @@ class ModelHandler(object):
         # retrieval (useful if the model is later modified)
         if((not hasattr(model, "model_hash_")) or force_rehash):
             model.model_hash_ = cls.hash_model_impl(model)
+            cls.hash_counters([model])
         return model.model_hash_
 
+    @classmethod
+    def cache_etag(cls, model):
+        """Stores the etag of the given model in memcache if the etag cache
+        is enabled."""
+        if Dispatcher.enable_etag_cache:
+            memcache.set(ETAG_CACHE_PREFIX + str(model.key()),
+                         model_hash_to_str(cls.hash_model(model)),
+                         Dispatcher.cache_time, namespace=CACHE_NAMESPACE)
+
+    @classmethod
+    def hash_models(cls, models):
+        """Computes the hashes of all the given models which have not yet
+        been hashed, looking up any available entity group versions in a
+        single batch."""
+        models = [model for model in models
+                  if not hasattr(model, "model_hash_")]
+        if(not models):
+            return
+
+        entity_groups = db.get([metadata.EntityGroup.key_for_entity(model)
+                                for model in models])
+        for model, entity_group in zip(models, entity_groups):
+            entity_version = None
+            if entity_group:
+                entity_version = entity_group.version
+            if entity_version:
+                model.model_hash_ = entity_version
+            else:
+                model.model_hash_ = cls.hash_model_content(model)
+        cls.hash_counters(models)
+
+    @classmethod
+    def hash_counters(cls, models):
+        """Folds the current totals of the sharded counters (if any) of the
+        given (just hashed) model instances into their hashes, so that
+        increments change the etags of the models."""
+        models = [model for model in models
+                  if (model.is_saved() and
+                      (model.kind() in cls.kind_counters))]
+        if(not models):
+            return
+
+        for model in models:
+            # always use the current totals
+            model.disp_counters_ = None
+        cls.load_counters(models)
+        for model in models:
+            totals = []
+            for prop_name, total in sorted(model.disp_counters_.iteritems()):
+                totals.extend((prop_name, total))
+            model.model_hash_ = model.model_hash_ ^ stable_hash(totals)
+
     @classmethod
     def hash_model_impl(cls, model):
         """Returns a hash of the model, suitable for an etag value."""
@@ -1650,19 +3169,19 @@ class ModelHandler(object):
             return entity_version
 
         # otherwise, create hash of all model props (and key)
-        model_hash = 0
-        for prop_key, prop_value in db.to_dict(model).iteritems():
-            prop_hash = hash(prop_key)
-            if is_list_type(prop_value):
-                for idx in range(0, len(prop_value)):
-                    prop_hash += (idx * hash(prop_value[idx]))
-            else:
-                prop_hash += hash(prop_value)
-            model_hash = model_hash ^ prop_hash
+        return cls.hash_model_content(model)
 
-        model_hash = model_hash ^ (hash(KEY_PROPERTY_NAME) + hash(model.key()))
-
-        return model_hash
+    @classmethod
+    def hash_model_content(cls, model):
+        """Returns a digest of all the properties (and key) of the model
+        which is stable across processes."""
+        digest = hashlib.md5()
+        digest_value(digest, KEY_PROPERTY_NAME)
+        digest_value(digest, model.key())
+        for prop_key, prop_value in sorted(db.to_dict(model).iteritems()):
+            digest_value(digest, prop_key)
+            digest_value(digest, prop_value)
+        return digest_to_hash(digest)
 
 
 # static collection of property handlers for BlobInfo types (because
@@ -1673,6 +3192,121 @@ BLOBINFO_PROP_HANDLERS = {
     "filename": PropertyHandler("filename", db.StringProperty()),
     "size": PropertyHandler("size", db.IntegerProperty())}
 
+# property handler for the tombstone deletion time
+TOMBSTONE_DELETED_HANDLER = DateTimeHandler(DELETED_ATTR_NAME,
+                                            db.DateTimeProperty())
+TOMBSTONE_KEY_NAME = "tombstone"
+TOMBSTONE_POSITION_SEP = "|"
+
+# property handler for the result of a 'count' aggregate query
+AGGREGATE_COUNT_HANDLER = PropertyHandler(AGGREGATE_COUNT,
+                                          db.IntegerProperty())
+
+
+class ModelTombstone(db.Model):
+    """Records the deletion (through the Dispatcher) of a model instance whose
+    type has a change feed.  Tombstones are children of the deleted model's
+    key, and are found using the feed_position, which combines the kind of
+    the deleted model and the deletion time."""
+
+    deleted = db.DateTimeProperty(indexed=False)
+    feed_position = db.StringProperty()
+
+    @classmethod
+    def create(cls, model_key, deleted):
+        """Returns a new tombstone for the given deleted model key."""
+        return cls(key=cls.get_key(model_key),
+                   deleted=deleted,
+                   feed_position=cls.get_feed_position(model_key.kind(),
+                                                       deleted))
+
+    @classmethod
+    def get_key(cls, model_key):
+        """Returns the key of the tombstone for the given model key."""
+        return db.Key.from_path(cls.kind(), TOMBSTONE_KEY_NAME,
+                                parent=model_key)
+
+    @classmethod
+    def get_feed_position(cls, kind, deleted):
+        """Returns the (sortable) feed position for the given kind and
+        deletion time."""
+        return (kind + TOMBSTONE_POSITION_SEP +
+                TOMBSTONE_DELETED_HANDLER.value_to_string(deleted))
+
+
+class GeoIndex(db.Model):
+    """Geohash index entry for a geo indexed GeoPt property (see the
+    geo_properties of Dispatcher.add_model()) of a model instance.  Entries
+    are children of the indexed model's key (named by property), and are found
+    using the geo_cell, which combines the kind of the indexed model, the
+    property name and the geohash of the location."""
+
+    geo_cell = db.StringProperty()
+
+    @classmethod
+    def get_key(cls, model_key, prop_name):
+        """Returns the key of the index entry for the given model key and
+        property name."""
+        return db.Key.from_path(cls.kind(), prop_name, parent=model_key)
+
+    @classmethod
+    def get_geo_cell(cls, kind, prop_name, geohash):
+        """Returns the geo_cell for the given kind, property name and
+        geohash (or geohash prefix)."""
+        return GEO_CELL_SEP.join((kind, prop_name, geohash))
+
+
+class CounterShard(db.Expando):
+    """One shard of a sharded counter property (see the sharded_counters of
+    Dispatcher.add_model()).  Shards are root entities (so increments of
+    different shards do not contend) named '<model key>|<property
+    name>|<shard index>', holding a partial sum in their 'value'
+    property.  Shards are deleted along with their model instance (by
+    ModelHandler.delete())."""
+
+    @classmethod
+    def get_keys(cls, model_key, prop_name, num_shards):
+        """Returns the keys of all the shards of the given counter."""
+        key_prefix = (str(model_key) + COUNTER_SHARD_SEP + prop_name +
+                      COUNTER_SHARD_SEP)
+        return [db.Key.from_path(cls.kind(), key_prefix + str(shard_idx),
+                                 namespace=model_key.namespace())
+                for shard_idx in xrange(num_shards)]
+
+    @classmethod
+    def get_total(cls, shard_keys):
+        """Returns the sum of the shards with the given keys."""
+        total = 0
+        for shard in cls.get_shards(shard_keys):
+            if shard:
+                total += shard.value
+        return total
+
+    @classmethod
+    def increment(cls, shard_key, delta):
+        """Adds the given delta to the shard with the given key (within a
+        transaction)."""
+        def increment_txn():
+            shard = cls.get(shard_key)
+            if(shard is None):
+                shard = cls(key=shard_key, value=delta)
+            else:
+                shard.value += delta
+            shard.put()
+        db.run_in_transaction(increment_txn)
+
+    @classmethod
+    @db.non_transactional
+    def get_shards(cls, shard_keys):
+        """Returns the shards with the given keys (None for missing shards).
+        Shards are never updated along with their model instance, so they
+        are read outside of any current transaction (and do not add entity
+        groups to it)."""
+        shards = []
+        for i in xrange(0, len(shard_keys), MAX_FETCH_PAGE_SIZE):
+            shards.extend(db.get(shard_keys[i:i + MAX_FETCH_PAGE_SIZE]))
+        return shards
+
 
 class DispatcherException(Exception):
     """Exception which contains an http error code to be returned from the
@@ -1704,11 +3338,126 @@ class Authenticator(object):
         pass
 
 
+class CachingAuthenticator(Authenticator):
+    """Authenticator which caches the principal resolved from the credentials
+    of a request (e.g. an access token), so that expensive validation (token
+    introspection, user lookups) is only done once per cache period.
+    Principals are cached in-process (for local_cache_time seconds) and in
+    memcache (for cache_time seconds), keyed by a digest of the
+    credentials.  The resolved principal is set as the dispatcher principal
+    (which is used by the default Authorizer.get_principal()).
+
+    Subclasses should override get_credentials() and resolve_principal()
+    (by default, all requests fail authentication).  Note, revoke() removes
+    cached principals from memcache and the local cache of the current
+    instance only, other instances may continue to accept revoked
+    credentials for up to local_cache_time seconds.
+    """
+
+    def __init__(self, cache_time=300, local_cache_time=30):
+        self.cache_time = cache_time
+        self.local_cache_time = local_cache_time
+        self.local_cache = ExpiringCache(MAX_CACHED_PRINCIPALS)
+
+    def authenticate(self, dispatcher):
+        """Authenticates the current request for the given dispatcher using
+        the cached principal for the request credentials, resolving (and
+        caching) the principal if necessary."""
+        credentials = self.get_credentials(dispatcher)
+        if(not credentials):
+            self.authentication_failed(dispatcher)
+
+        cache_key = self.get_cache_key(credentials)
+        principal = self.local_cache.get(cache_key)
+        if(principal is None):
+            principal = memcache.get(cache_key, namespace=CACHE_NAMESPACE)
+            if(principal is None):
+                principal = self.resolve_principal(dispatcher, credentials)
+                if(principal is None):
+                    self.authentication_failed(dispatcher)
+                memcache.set(cache_key, principal, self.cache_time,
+                             namespace=CACHE_NAMESPACE)
+            self.local_cache.put(cache_key, principal,
+                                 min(self.local_cache_time, self.cache_time))
+
+        dispatcher.principal = principal
+
+    def revoke(self, credentials):
+        """Removes any cached principal for the given credentials (see the
+        class docs for caveats)."""
+        cache_key = self.get_cache_key(credentials)
+        self.local_cache.delete(cache_key)
+        memcache.delete(cache_key, namespace=CACHE_NAMESPACE)
+
+    def get_cache_key(self, credentials):
+        """Returns the cache key for the given credentials (which are never
+        stored directly)."""
+        if isinstance(credentials, unicode):
+            credentials = credentials.encode("utf-8")
+        return PRINCIPAL_CACHE_PREFIX + hashlib.sha256(credentials).hexdigest()
+
+    def get_credentials(self, dispatcher):
+        """Returns the credentials string (e.g. an access token) of the
+        current request for the given dispatcher, or None if the request has
+        no credentials.
+
+        Args:
+          dispatcher: the dispatcher for the request to be authenticated
+        """
+        return None
+
+    def resolve_principal(self, dispatcher, credentials):
+        """Returns the principal (a picklable identifier of the user) for the
+        given credentials, or None if the credentials are not valid.
+
+        Args:
+          dispatcher: the dispatcher for the request to be authenticated
+          credentials: the credentials returned by get_credentials()
+        """
+        return None
+
+    def authentication_failed(self, dispatcher):
+        """Called when the current request for the given dispatcher has
+        missing or invalid credentials, raises a DispatcherException (by
+        default with a 403 error code, see the Dispatcher.forbidden()
+        method).
+
+        Args:
+          dispatcher: the dispatcher for the request to be authenticated
+        """
+        dispatcher.forbidden()
+
+
 class Authorizer(object):
     """Handles authorization for REST API calls.  In general, authorization
     failures in can_* methods should raise a DispatcherException with an
     appropriate error code while filter_* methods should simply remove any
-    unauthorized data."""
+    unauthorized data.
+
+    The Dispatcher remembers the decisions of the can_read*() and
+    can_delete*() methods for each model key for the rest of the current
+    request (and, if the Dispatcher auth_cache_time property is set, for
+    subsequent requests by the same principal, see get_principal()), so
+    these decisions should only depend on the principal and the model key
+    (or stored model)."""
+
+    def get_principal(self, dispatcher):
+        """Returns an identifier of the principal (user) associated with the
+        current request for the given dispatcher, used to remember
+        authorization decisions across requests, or None if decisions should
+        not be remembered across requests.  The default implementation
+        returns the principal set on the dispatcher by the Authenticator (if
+        any), otherwise the id of the current Google Accounts user (if any).
+
+        Args:
+          dispatcher: the dispatcher for the request to be authorized
+        """
+        if(dispatcher.principal is not None):
+            return dispatcher.principal
+        user = users.get_current_user()
+        if user:
+            return user.user_id()
+        return None
 
     def can_read_metadata(self, dispatcher, model_name):
         """Returns if the metadata of the model with the given model_name is
@@ -1745,10 +3494,25 @@ class Authorizer(object):
         """
         pass
 
-    def filter_read(self, dispatcher, models):
-        """Returns the models from the given list which can be read by the
-        user associated with the current request for the given dispatcher.
-        Note, the check_query() method can also be used to filter the models
+    def can_read_multi(self, dispatcher, models):
+        """Returns if all the given models can be read by the user associated
+        with the current request for the given dispatcher, otherwise raises a
+        DispatcherException with an appropriate error code (see the
+        Dispatcher.forbidden() method).  The default implementation calls
+        can_read() for each model, implementations which can authorize the
+        models as a group should override this method.
+
+        Args:
+          dispatcher: the dispatcher for the request to be authorized
+          models: the models to be read
+        """
+        for model in models:
+            self.can_read(dispatcher, model)
+
+    def filter_read(self, dispatcher, models):
+        """Returns the models from the given list which can be read by the
+        user associated with the current request for the given dispatcher.
+        Note, the check_query() method can also be used to filter the models
         retrieved from a query.
 
         Args:
@@ -1757,6 +3521,31 @@ class Authorizer(object):
         """
         return models
 
+    def filter_read_deleted(self, dispatcher, model_keys):
+        """Returns the keys from the given list of deleted model keys which
+        may be returned (from a 'deleted_since' change query) to the user
+        associated with the current request for the given dispatcher.
+
+        Args:
+          dispatcher: the dispatcher for the request to be authorized
+          model_keys: the keys of the deleted models
+        """
+        return model_keys
+
+    def can_read_query_stats(self, dispatcher):
+        """Returns if the query statistics (see the Dispatcher
+        enable_query_stats property) can be read by the user associated with
+        the current request for the given dispatcher, otherwise raises a
+        DispatcherException with an appropriate error code (see the
+        Dispatcher.forbidden() method).  By default, only application
+        administrators may read the query statistics.
+
+        Args:
+          dispatcher: the dispatcher for the request to be authorized
+        """
+        if(not users.is_current_user_admin()):
+            dispatcher.forbidden()
+
     def check_query(self, dispatcher, query_expr, query_params):
         """Verifies/modifies the given query so that it is valid for the user
         associated with the current request for the given dispatcher.  For
@@ -1783,7 +3572,9 @@ class Authorizer(object):
         """Returns if the given model can be modified by the user associated
         with the current request for the given dispatcher, otherwise raises a
         DispatcherException with an appropriate error code (see the
-        Dispatcher.forbidden() method).
+        Dispatcher.forbidden() method).  For in-place updates (e.g. list
+        'append'), this is called within the (cross group) transaction which
+        saves the model, and may be called again if it is retried.
 
         Args:
           dispatcher: the dispatcher for the request to be authorized
@@ -1793,6 +3584,23 @@ class Authorizer(object):
         """
         pass
 
+    def can_write_multi(self, dispatcher, models, is_replace):
+        """Returns if all the given models can be modified by the user
+        associated with the current request for the given dispatcher,
+        otherwise raises a DispatcherException with an appropriate error code
+        (see the Dispatcher.forbidden() method).  The default implementation
+        calls can_write() for each model, implementations which can authorize
+        the models as a group should override this method.
+
+        Args:
+          dispatcher: the dispatcher for the request to be authorized
+          models: the models to be modified
+          is_replace: True if this is a full update (PUT), False otherwise
+                      (POST)
+        """
+        for model in models:
+            self.can_write(dispatcher, model, is_replace)
+
     def filter_write(self, dispatcher, models, is_replace):
         """Returns the models from the given list which can be modified by
         the user associated with the current request for the given
@@ -1834,6 +3642,22 @@ class Authorizer(object):
         """
         pass
 
+    def can_delete_multi(self, dispatcher, model_type, model_keys):
+        """Returns if all the given models can be deleted by the user
+        associated with the current request for the given dispatcher,
+        otherwise raises a DispatcherException with an appropriate error code
+        (see the Dispatcher.forbidden() method).  The default implementation
+        calls can_delete() for each key, implementations which can authorize
+        the keys as a group should override this method.
+
+        Args:
+          dispatcher: the dispatcher for the request to be authorized
+          model_type: the class of the models to be be deleted
+          model_keys: the keys of the models to be deleted
+        """
+        for model_key in model_keys:
+            self.can_delete(dispatcher, model_type, model_key)
+
     def check_delete_query(self, dispatcher, query_expr, query_params):
         """Verifies/modifies the given delete query so that it is valid for
         the user associated with the current request for the given
@@ -1859,10 +3683,12 @@ class CachedResponse(object):
             self.out = response.out.getvalue()
         else:
             self.out = response.out.body
-        self.content_type = response.disp_out_type_
+        self.content_type = dispatcher.context.out_type
         self.accept = unicode(request.accept)
+        self.expires = time.time() + Dispatcher.cache_time
+        self.etag = None
         if Dispatcher.enable_etags:
-            self.etag = response.headers[ETAG_HEADER]
+            self.etag = response.headers.get(ETAG_HEADER, None)
 
     def matches_request(self, request):
         """Checks if the given request acceptably matches the request which
@@ -1871,10 +3697,15 @@ class CachedResponse(object):
         # a cached response
         return self.accept == unicode(request.accept)
 
+    def is_stale(self):
+        """Checks if this cached response is older than the configured
+        cache_time (but still within the configured cache_stale_time)."""
+        return time.time() > self.expires
+
     def is_not_modified(self, dispatcher):
         """Checks if the cache response is unmodified with respect to the
         given request."""
-        return (Dispatcher.enable_etags and
+        return (Dispatcher.enable_etags and self.etag and
                 (self.etag.strip('"') in dispatcher.request.if_none_match))
 
     def write_output(self, dispatcher):
@@ -1886,6 +3717,256 @@ class CachedResponse(object):
             dispatcher.response.headers[ETAG_HEADER] = self.etag
 
 
+class ExpiringCache(object):
+    """Simple thread-safe, in-process LRU cache (of at most max_size
+    entries) whose entries expire after a given time."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the unexpired value cached for the given key, or the given
+        default."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if((entry is None) or (entry[1] <= time.time())):
+                return default
+            # re-insert as the most recently used entry
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, cache_time):
+        """Caches the given value for the given key for cache_time
+        seconds."""
+        with self.lock:
+            self.entries.pop(key, None)
+            if(len(self.entries) >= self.max_size):
+                self.entries.popitem(False)
+            self.entries[key] = (value, time.time() + cache_time)
+
+    def delete(self, key):
+        """Removes any value cached for the given key."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Removes all cached values."""
+        with self.lock:
+            self.entries.clear()
+
+# authorization decisions remembered across requests by this instance
+AUTH_DECISIONS = ExpiringCache(MAX_AUTH_DECISIONS)
+
+
+class InFlightGet(object):
+    """Simple class used to share the response of a get request with
+    identical requests which arrive while it is being computed."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+# in-flight get requests for this instance, keyed by (url, accept)
+IN_FLIGHT_GETS = {}
+IN_FLIGHT_GETS_LOCK = threading.Lock()
+
+
+class RequestContext(object):
+    """Simple class holding the state of a single request handled by a
+    Dispatcher (instead of keeping it on shared objects).  The namespace in
+    effect when the request started is restored by restore()."""
+
+    def __init__(self):
+        self.namespace = namespace_manager.get_namespace()
+        self.query_params = None
+        self.out_type = TEXT_CONTENT_TYPE
+        self.cache_response = True
+        self.auth_decisions = {}
+
+    def restore(self):
+        """Restores the namespace in effect when the request started."""
+        namespace_manager.set_namespace(self.namespace)
+
+
+def request_scoped(handler_method):
+    """Decorator for Dispatcher request methods which restores the request
+    context (see RequestContext.restore()) once the request is done."""
+
+    @functools.wraps(handler_method)
+    def wrapper(self, *args):
+        try:
+            return handler_method(self, *args)
+        finally:
+            self.context.restore()
+    return wrapper
+
+# guards freezing of the registered model handlers
+MODEL_HANDLERS_LOCK = threading.Lock()
+
+
+class BatchOp(object):
+    """Simple class holding a single operation of a batch request (see
+    Dispatcher.batch_impl()) and its result."""
+
+    def __init__(self, op_el, base_url):
+        self.method = str(op_el.getAttribute(METHOD_ATTR_NAME)).upper()
+        path = str(op_el.getAttribute(PATH_ATTR_NAME))
+        if(base_url and path.startswith(base_url)):
+            path = path[len(base_url):]
+        self.path = [i for i in path.split('/') if i]
+        self.model_els = [node for node in op_el.childNodes
+                          if node.nodeType == node.ELEMENT_NODE]
+        self.model_handler = None
+        self.model_key = None
+        self.namespace = None
+        self.result = None
+        self.status = None
+
+# errors which fail a single batch operation (others fail the whole batch)
+BATCH_OP_ERRORS = (DispatcherException, datastore_errors.BadValueError,
+                   datastore_errors.BadRequestError,
+                   datastore_errors.BadKeyError, db.KindError)
+
+
+def get_latency_bucket(latency):
+    """Returns the name of the histogram bucket for the given latency (in
+    seconds)."""
+    latency_ms = latency * 1000
+    for bucket in QUERY_STATS_BUCKETS:
+        if(latency_ms <= bucket):
+            return str(bucket)
+    return QUERY_STATS_OVERFLOW_BUCKET
+
+
+class QueryStats(object):
+    """Collects counters and latency histograms for each query 'shape' (see
+    ModelQuery.get_shape()) run by the Dispatcher.  Counts are accumulated
+    in-process and periodically added to the shared totals in memcache (so
+    the totals cover all instances, but are lost on memcache eviction)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shapes = {}
+        self.counters = {}
+        self.last_flush = time.time()
+
+    def record(self, shape, num_models, fetch_time, output_time,
+               need_index=False):
+        """Records a single run of a query with the given shape, the number
+        of models returned and the time (in seconds) taken by the datastore
+        fetch and the output serialization.  Flushes the collected counts to
+        memcache if the configured query_stats_flush_interval has passed."""
+        counters = {QUERY_STATS_COUNT: 1}
+        if need_index:
+            counters[QUERY_STATS_NEED_INDEX] = 1
+        else:
+            counters[QUERY_STATS_MODELS] = num_models
+            for stat, latency in ((QUERY_STATS_FETCH, fetch_time),
+                                  (QUERY_STATS_OUTPUT, output_time)):
+                counters[stat + QUERY_STATS_SEP + QUERY_STATS_TOTAL_MS] = (
+                    int(latency * 1000))
+                counters[stat + QUERY_STATS_SEP +
+                         get_latency_bucket(latency)] = 1
+
+        shape_id = hashlib.md5(repr(shape)).hexdigest()
+        self.lock.acquire()
+        try:
+            self.shapes[shape_id] = shape
+            for stat, delta in counters.iteritems():
+                counter_key = shape_id + QUERY_STATS_SEP + stat
+                self.counters[counter_key] = (
+                    self.counters.get(counter_key, 0) + delta)
+            do_flush = ((time.time() - self.last_flush) >=
+                        Dispatcher.query_stats_flush_interval)
+        finally:
+            self.lock.release()
+
+        if do_flush:
+            self.flush()
+
+    def flush(self):
+        """Adds the counts collected by this instance to the shared totals in
+        memcache."""
+        self.lock.acquire()
+        try:
+            shapes, self.shapes = self.shapes, {}
+            counters, self.counters = self.counters, {}
+            self.last_flush = time.time()
+        finally:
+            self.lock.release()
+
+        if not shapes:
+            return
+
+        memcache.set_multi(
+            dict([(shape_id + QUERY_STATS_SEP + QUERY_STATS_SHAPE, shape)
+                  for shape_id, shape in shapes.iteritems()]),
+            key_prefix=QUERY_STATS_CACHE_PREFIX, namespace=CACHE_NAMESPACE)
+        memcache.offset_multi(counters, key_prefix=QUERY_STATS_CACHE_PREFIX,
+                              namespace=CACHE_NAMESPACE, initial_value=0)
+        self.register_shapes(frozenset(shapes.iterkeys()))
+
+    def register_shapes(self, shape_ids):
+        """Adds the given shape ids to the set of all known shape ids in
+        memcache."""
+        client = memcache.Client()
+        for _ in xrange(QUERY_STATS_MAX_CAS_RETRIES):
+            all_shape_ids = client.gets(QUERY_STATS_SHAPES_KEY,
+                                        namespace=CACHE_NAMESPACE)
+            if(all_shape_ids is None):
+                if client.add(QUERY_STATS_SHAPES_KEY, shape_ids,
+                              namespace=CACHE_NAMESPACE):
+                    return
+            elif(shape_ids <= all_shape_ids):
+                return
+            elif client.cas(QUERY_STATS_SHAPES_KEY,
+                            all_shape_ids | shape_ids,
+                            namespace=CACHE_NAMESPACE):
+                return
+        logging.warning("failed registering %d query shapes", len(shape_ids))
+
+    def load(self):
+        """Returns a list of (shape, counters) tuples for all the query shapes
+        with totals in memcache (after flushing the counts collected by this
+        instance)."""
+        self.flush()
+        shape_ids = memcache.get(QUERY_STATS_SHAPES_KEY,
+                                 namespace=CACHE_NAMESPACE)
+        if not shape_ids:
+            return []
+
+        stats = [QUERY_STATS_SHAPE, QUERY_STATS_COUNT, QUERY_STATS_MODELS,
+                 QUERY_STATS_NEED_INDEX]
+        for stat in (QUERY_STATS_FETCH, QUERY_STATS_OUTPUT):
+            for bucket in ([str(b) for b in QUERY_STATS_BUCKETS] +
+                           [QUERY_STATS_OVERFLOW_BUCKET,
+                            QUERY_STATS_TOTAL_MS]):
+                stats.append(stat + QUERY_STATS_SEP + bucket)
+
+        values = memcache.get_multi(
+            [shape_id + QUERY_STATS_SEP + stat
+             for shape_id in shape_ids for stat in stats],
+            key_prefix=QUERY_STATS_CACHE_PREFIX, namespace=CACHE_NAMESPACE)
+
+        results = []
+        for shape_id in sorted(shape_ids):
+            shape = values.get(
+                shape_id + QUERY_STATS_SEP + QUERY_STATS_SHAPE, None)
+            if(shape is None):
+                continue
+            counters = {}
+            for stat in stats[1:]:
+                counters[stat] = int(values.get(
+                    shape_id + QUERY_STATS_SEP + stat, 0))
+            results.append((shape, counters))
+        return results
+
+# query statistics collected by this instance
+QUERY_STATS = QueryStats()
+
+
 class Dispatcher(webapp.RequestHandler):
     """RequestHandler which presents a REST based API for interacting with
     the datastore of a Google App Engine application.
@@ -1896,12 +3977,28 @@ class Dispatcher(webapp.RequestHandler):
     methods.  Example usage is include in the module level documentation.
 
     This handler has builtin support for caching get requests using the
-    memcache API.  This can be controlled via two class properties:
+    memcache API (responses larger than the memcache value limit are split
+    across multiple entries).  This can be controlled via two class
+    properties:
 
         caching: True to enable caching, False to disable
 
         cache_time: Time in seconds for results to be cached
 
+        cache_stale_time: Additional time in seconds for which an expired
+                          cached result may be returned while a single
+                          request recomputes it.  Defaults to 0 (expired
+                          results are never returned)
+
+        cache_lock_time: Maximum time in seconds that a single request may
+                         hold the lock for recomputing a cached result.
+                         Defaults to 10
+
+        cache_lock_wait: Maximum time in seconds that a request will wait
+                         for a result being recomputed by another request
+                         when no stale result is available (after which it
+                         recomputes the result itself).  Defaults to 0.5
+
         base_url: URL prefix expected on requests
 
         fetch_page_size: number of instances to return per get-all call
@@ -1931,6 +4028,10 @@ class Dispatcher(webapp.RequestHandler):
                            (only used if enable_delete_query is True).
                            Defaults to False
 
+        enable_batch: whether or not batch requests ('POST /$batch') are
+                      supported, see Dispatcher.batch_impl() for details.
+                      Defaults to False
+
         external_namespaces: a set of values which control how namespaces are
                              handled external to the handler.  The allowabled
                              values in the set are zero or more of READ and
@@ -1951,11 +4052,86 @@ class Dispatcher(webapp.RequestHandler):
                              the wiki).  Defaults to hidden external
                              namespaces (empty set)
 
+        coalesce_gets: whether or not identical get requests (same url and
+                       accept header) running concurrently in the same
+                       instance should share a single result.  If a custom
+                       Authorizer is configured, only requests of the same
+                       principal (see Authorizer.get_principal()) share
+                       results.  Defaults to False
+
+        coalesce_wait: Maximum time in seconds that a coalesced get request
+                       will wait for the shared result before computing its
+                       own result.  Defaults to 10
+
+        enable_aggregate_query: whether or not aggregate queries (e.g.
+                                '?aggregate=count' or
+                                '?aggregate=sum:<property>') are supported.
+                                Note, aggregate queries are restricted by
+                                the Authorizer's check_query() method, but
+                                not its filter_read() method.  Defaults to
+                                False
+
+        aggregate_cache_time: Time in seconds for aggregate query results to
+                              be cached (cached results are discarded when
+                              models of the relevant type are modified
+                              through this handler).  Defaults to 0 (no
+                              caching)
+
+        enable_query_stats: whether or not counters and latency histograms
+                            (datastore fetch vs. output serialization) are
+                            collected for each query 'shape' (model, filter
+                            fields, orderings and page size).  The
+                            statistics are available from
+                            '/__query_stats' (subject to the Authorizer's
+                            can_read_query_stats() method), and
+                            '/__query_stats?type=index' returns suggested
+                            index.yaml entries for the query shapes which
+                            failed due to a missing composite index.
+                            Defaults to False
+
+        query_stats_flush_interval: Time in seconds between flushes of the
+                                    query statistics collected by an
+                                    instance to memcache.  Defaults to 60
+
+        auth_cache_time: Time in seconds for which an instance remembers the
+                         read and delete authorization decisions made for a
+                         principal (see Authorizer.get_principal()), so that
+                         later requests by the same principal for the same
+                         models skip the Authorizer.  Decisions are always
+                         remembered for the rest of the current request.
+                         Defaults to 0 (not remembered across requests)
+
         enable_etags: whether or not etags (and related) headers are sent and
                       honored.  if enabled, 'If-Match' will be checked on sets
                       and 'If-None-Match' will be checked on gets.
                       Defaults to False
 
+        enable_etag_cache: whether or not the etags of models (and of cached
+                           query results) are also stored in memcache so
+                           that 'If-None-Match' requests can be answered
+                           without querying the datastore (only used if
+                           enable_etags is True).  Model etags are kept up
+                           to date by updates made through this handler,
+                           changes made elsewhere may go unnoticed for up to
+                           cache_time seconds.  Single model requests are
+                           only answered from memcache (before fetching the
+                           model) if the read is known to be allowed (the
+                           default Authorizer or a remembered decision, see
+                           auth_cache_time), otherwise after the model is
+                           fetched and authorized.  Note, the Authorizer is
+                           not consulted for not modified responses of
+                           cached query results.  Defaults to False
+
+        enable_offset_cursors: whether or not the cursor at the end of each
+                               page of query results is stored in memcache
+                               (for cache_time seconds) so that a later
+                               request using the matching numeric 'offset'
+                               is fetched using the cursor instead of having
+                               the datastore skip all preceding results.
+                               Numeric offset pages then indicate a next
+                               offset whenever the page is full (like cursor
+                               pages).  Defaults to False
+
         simple_json_lists: whether or not json value lists should be
                            simplified.  by default, the json output closely
                            matches the xml output.  however, since json
@@ -1973,6 +4149,9 @@ class Dispatcher(webapp.RequestHandler):
 
     caching = False
     cache_time = 300
+    cache_stale_time = 0
+    cache_lock_time = 10
+    cache_lock_wait = 0.5
     base_url = ""
     fetch_page_size = 50
     authenticator = Authenticator()
@@ -1986,9 +4165,19 @@ class Dispatcher(webapp.RequestHandler):
     include_docstring_in_schema = False
     enable_delete_query = False
     enable_delete_all = False
+    enable_batch = False
+    enable_aggregate_query = False
+    aggregate_cache_time = 0
+    enable_query_stats = False
+    query_stats_flush_interval = 60
+    auth_cache_time = 0
     external_namespaces = HIDDEN_EXT_NAMESPACES
     enable_etags = False
+    enable_etag_cache = False
+    enable_offset_cursors = False
     simple_json_lists = False
+    coalesce_gets = False
+    coalesce_wait = 10
 
     model_handlers = {}
 
@@ -2075,9 +4264,25 @@ class Dispatcher(webapp.RequestHandler):
 
             cls.add_model(model_name, model_type, model_methods)
 
+    @classmethod
+    def prune_tombstones(cls, max_age):
+        """Deletes the tombstones (see the changes_property of add_model())
+        of model instances deleted more than max_age seconds ago, for all
+        model types with a change feed (in the current namespace).  Should be
+        called periodically, e.g. from a cron handler.  Returns the number of
+        deleted tombstones.
+        Note, 'deleted_since' queries which start before max_age ago may
+        miss deletes."""
+        num_pruned = 0
+        for model_handler in cls.model_handlers.itervalues():
+            if model_handler.changes_property:
+                num_pruned += model_handler.prune_tombstones(max_age)
+        return num_pruned
+
     @classmethod
     def add_model(cls, model_name, model_type,
-                  model_methods=ALL_MODEL_METHODS):
+                  model_methods=ALL_MODEL_METHODS, changes_property=None,
+                  geo_properties=None, sharded_counters=None):
         """Adds the given model to this request handler.  The name (with
         invalid characters converted to the '_' character) will be used as
         the REST path for relevant Model value.
@@ -2092,7 +4297,40 @@ class Dispatcher(webapp.RequestHandler):
           model_methods: optional methods supported for the given model (one
                          or more of ['GET', 'POST', 'PUT', 'DELETE',
                          'GET_METADATA']), defaults to all methods
+          changes_property: optional name of a DateTimeProperty (with
+                            auto_now=True) of the given model which enables
+                            change queries ('?changes_since=<datetime>'
+                            returns the models modified after the given
+                            time, in update order).  Deletes made through
+                            this handler are recorded as tombstones
+                            ('?deleted_since=<datetime>' returns the keys of
+                            the models deleted after the given time).
+                            Change queries always return a cursor offset,
+                            later changes are found by repeating the query
+                            with that offset (timestamps may tie, so the
+                            feed is never resumed from a timestamp).
+                            Tombstones are kept until removed with
+                            prune_tombstones() (e.g. from a cron handler)
+          geo_properties: optional list of names of GeoPtProperties of the
+                          given model which are indexed (by geohash) for
+                          bounding box ('?fbbox_<property>=<south>,<west>,
+                          <north>,<east>') and proximity ('?fnear_<property>=
+                          <lat>,<lon>,<radius km>') queries.  The index is
+                          maintained by writes made through this handler
+          sharded_counters: optional dict of names of IntegerProperties or
+                            FloatProperties of the given model to the number
+                            of shards to use for the counter.  Sharded
+                            counters are only modified by increments
+                            ('POST /<type>/<key>/<property>?op=incr&by=N'),
+                            which update a random shard, and are read as
+                            the sum of the shards.  The counter totals are
+                            part of the etag of the model, so computing the
+                            etag reads the shards.  A model type may only
+                            be added with one set of sharded counters
         """
+        if isinstance(cls.model_handlers, FrozenDict):
+            raise ValueError("cannot add model %s after the first request" %
+                             model_name)
         xml_name = convert_to_valid_xml_name(model_name)
         if(xml_name == METADATA_PATH):
             raise ValueError("cannot use name %s" % METADATA_PATH)
@@ -2101,8 +4339,44 @@ class Dispatcher(webapp.RequestHandler):
         if(not issubclass(model_type, db.Model)):
             raise ValueError("given model type %s is not a subclass of Model" %
                              model_type)
+        if changes_property:
+            changes_prop_type = model_type.properties().get(changes_property,
+                                                            None)
+            if(not isinstance(changes_prop_type, db.DateTimeProperty)):
+                raise ValueError("changes property %s is not a "
+                                 "DateTimeProperty" % changes_property)
+            if(not changes_prop_type.auto_now):
+                logging.warning("changes property %s is not auto_now",
+                                changes_property)
+        for geo_property in (geo_properties or ()):
+            if(not isinstance(model_type.properties().get(geo_property, None),
+                              db.GeoPtProperty)):
+                raise ValueError("geo property %s is not a GeoPtProperty" %
+                                 geo_property)
+        for counter_property, num_shards in (
+            (sharded_counters or {}).iteritems()):
+            if(not isinstance(model_type.properties().get(counter_property,
+                                                          None),
+                              (db.IntegerProperty, db.FloatProperty))):
+                raise ValueError("sharded counter %s is not an "
+                                 "IntegerProperty or FloatProperty" %
+                                 counter_property)
+            if(num_shards < 1):
+                raise ValueError("sharded counter %s must have at least one "
+                                 "shard" % counter_property)
+        if(ModelHandler.kind_counters.get(model_type.kind(),
+                                          sharded_counters or {}) !=
+           (sharded_counters or {})):
+            raise ValueError("model type %s already added with different "
+                             "sharded counters" % model_type)
+        if sharded_counters:
+            ModelHandler.kind_counters[model_type.kind()] = dict(
+                sharded_counters)
         cls.model_handlers[xml_name] = ModelHandler(model_name, model_type,
-                                                    model_methods)
+                                                    model_methods,
+                                                    changes_property,
+                                                    geo_properties,
+                                                    sharded_counters)
         logging.info("added model %s with type %s for methods %s", model_name,
                      model_type, model_methods)
 
@@ -2118,42 +4392,164 @@ class Dispatcher(webapp.RequestHandler):
 
     def initialize(self, request, response):
         super(Dispatcher, self).initialize(request, response)
-        if request:
-            request.disp_query_params_ = None
-        if response:
-            response.disp_cache_resp_ = True
-            response.disp_out_type_ = TEXT_CONTENT_TYPE
+        self.freeze_model_handlers()
+        self.context = RequestContext()
+        # the principal (if any) resolved by the Authenticator
+        self.principal = None
+
+    @classmethod
+    def freeze_model_handlers(cls):
+        """Makes the registered model handlers immutable (called when the
+        first request is handled), so that concurrent requests only ever read
+        the shared handler state.  Models cannot be added afterwards."""
+        if isinstance(cls.model_handlers, FrozenDict):
+            return
+        with MODEL_HANDLERS_LOCK:
+            if isinstance(cls.model_handlers, FrozenDict):
+                return
+            for model_handler in cls.model_handlers.itervalues():
+                model_handler.freeze()
+            cls.model_handlers = FrozenDict(cls.model_handlers)
 
+    @request_scoped
     def get(self, *_):
         """Does a REST get, optionally using memcache to cache results.  See
         get_impl() for more details."""
 
         self.authenticator.authenticate(self)
 
-        if not self.caching:
-            self.get_impl()
+        # partial (Range) responses are neither cached nor shared
+        if((not self.caching) or (RANGE_HEADER in self.request.headers)):
+            self.get_impl_coalesced()
             return
 
         # attempt to return cached response
-        cached_response = memcache.get(self.request.url)
+        cache_key = self.request.url
+        self.check_cached_etag(QUERY_ETAG_CACHE_PREFIX + cache_key)
+        cached_response = self.get_cached_response(cache_key)
+        if cached_response and not cached_response.is_stale():
+            self.write_cached_response(cached_response)
+            return
+
+        # only one request gets to recompute a missing/stale response, the
+        # others use the stale response (if any) or wait briefly for the new
+        # response
+        lock_key = CACHE_LOCK_PREFIX + cache_key
+        if not memcache.add(lock_key, 1, self.cache_lock_time,
+                            namespace=CACHE_NAMESPACE):
+            if not cached_response:
+                cached_response = self.wait_for_cached_response(cache_key)
+            if cached_response:
+                self.write_cached_response(cached_response)
+                return
+            lock_key = None
+
+        try:
+            self.get_impl_coalesced()
+
+            # don't cache blobinfo content requests
+            if self.context.cache_response:
+                cached_response = CachedResponse(self)
+                if not cache_set(cache_key, pickle.dumps(cached_response),
+                                 self.cache_time + self.cache_stale_time):
+                    logging.warning("memcache set failed for %s", cache_key)
+                elif self.enable_etag_cache and cached_response.etag:
+                    memcache.set(QUERY_ETAG_CACHE_PREFIX + cache_key,
+                                 cached_response.etag.strip('"'),
+                                 self.cache_time + self.cache_stale_time,
+                                 namespace=CACHE_NAMESPACE)
+        finally:
+            if lock_key:
+                memcache.delete(lock_key, namespace=CACHE_NAMESPACE)
+
+    def get_impl_coalesced(self):
+        """Calls get_impl(), sharing the result between identical requests
+        running concurrently in this instance if coalesce_gets is enabled.
+        Requests which are waiting on a failed (or uncacheable) request
+        compute their own result."""
+        flight_key = None
+        if self.coalesce_gets:
+            flight_key = self.get_flight_key()
+        if flight_key is None:
+            self.get_impl()
+            return
+
+        IN_FLIGHT_GETS_LOCK.acquire()
+        try:
+            in_flight = IN_FLIGHT_GETS.get(flight_key, None)
+            is_leader = (in_flight is None)
+            if is_leader:
+                in_flight = InFlightGet()
+                IN_FLIGHT_GETS[flight_key] = in_flight
+        finally:
+            IN_FLIGHT_GETS_LOCK.release()
+
+        if not is_leader:
+            in_flight.done.wait(self.coalesce_wait)
+            if in_flight.response:
+                self.write_cached_response(in_flight.response)
+            else:
+                self.get_impl()
+            return
+
+        try:
+            self.get_impl()
+            if self.context.cache_response:
+                in_flight.response = CachedResponse(self)
+        finally:
+            IN_FLIGHT_GETS_LOCK.acquire()
+            try:
+                del IN_FLIGHT_GETS[flight_key]
+            finally:
+                IN_FLIGHT_GETS_LOCK.release()
+            in_flight.done.set()
+
+    def get_flight_key(self):
+        """Returns the key used to share the result of the current get
+        request with identical concurrent requests, or None if the result
+        should not be shared.  When a custom Authorizer is configured,
+        results are only shared between requests of the same principal (see
+        Authorizer.get_principal()), and never for requests without a
+        principal.  Range requests are never shared."""
+        if(RANGE_HEADER in self.request.headers):
+            return None
+        flight_key = (self.request.url, unicode(self.request.accept))
+        if(type(self.authorizer) is not Authorizer):
+            principal = self.authorizer.get_principal(self)
+            if(principal is None):
+                return None
+            flight_key += (principal,)
+        return flight_key
+
+    def get_cached_response(self, cache_key):
+        """Returns the CachedResponse for the given key if one exists which
+        matches the current request, None otherwise."""
+        cached_response = cache_get(cache_key)
         if cached_response:
             cached_response = pickle.loads(cached_response)
             # only use cache response if the requests match
             if cached_response.matches_request(self.request):
-                if cached_response.is_not_modified(self):
-                    self.not_modified()
-                cached_response.write_output(self)
-                return
+                return cached_response
+        return None
 
-        self.get_impl()
+    def wait_for_cached_response(self, cache_key):
+        """Polls for a CachedResponse for the given key (which is being
+        computed by another request) for up to cache_lock_wait seconds.
+        Returns the CachedResponse, or None if it did not appear in time."""
+        wait_until = time.time() + self.cache_lock_wait
+        while time.time() < wait_until:
+            time.sleep(CACHE_LOCK_POLL_INTERVAL)
+            cached_response = self.get_cached_response(cache_key)
+            if cached_response:
+                return cached_response
+        return None
 
-        # don't cache blobinfo content requests
-        if self.response.disp_cache_resp_:
-            cached_response = pickle.dumps(CachedResponse(self))
-            if not memcache.set(self.request.url, cached_response,
-                                self.cache_time):
-                logging.warning("memcache set failed for %s",
-                                self.request.url)
+    def write_cached_response(self, cached_response):
+        """Writes the given CachedResponse (or the not modified response
+        code) to the current response."""
+        if cached_response.is_not_modified(self):
+            self.not_modified()
+        cached_response.write_output(self)
 
     def get_impl(self):
         """Actual implementation of REST get.  Gets metadata (types,
@@ -2174,9 +4570,12 @@ class Dispatcher(webapp.RequestHandler):
         if model_name == METADATA_PATH:
             out = self.get_metadata(path)
 
+        elif(model_name == QUERY_STATS_PATH):
+            out = self.get_query_stats()
+
         elif(model_name == BLOBUPLOADRESULT_PATH):
             # this is the final call from a blobinfo upload
-            self.response.disp_cache_resp_ = False
+            self.context.cache_response = False
             path.append(BLOBUPLOADRESULT_PATH)
             model_name = path.pop(0)
             model_key = path.pop(0)
@@ -2188,11 +4587,20 @@ class Dispatcher(webapp.RequestHandler):
             model_name = model_handler.model_name
 
             list_props = {}
+            model_query = None
             if (len(path) > 0):
                 model_key = path.pop(0)
+                # revalidations of models the caller is already known to be
+                # allowed to read are answered without a datastore read
+                self.check_cached_model_etag(model_handler, model_key)
                 models = model_handler.get(model_key)
+                if models is None:
+                    self.not_found()
 
-                self.authorizer.can_read(self, models)
+                self.authorize_read([models])
+                # only answer from the etag cache once the caller is known
+                # to be allowed to read the model
+                self.check_cached_etag(ETAG_CACHE_PREFIX + str(models.key()))
 
                 if (len(path) > 0):
                     # single property get
@@ -2206,18 +4614,37 @@ class Dispatcher(webapp.RequestHandler):
                     return
 
             else:
-                models = self.get_all_impl(model_handler, list_props)
+                model_query = ModelQuery()
+                model_query.parse(self, model_handler)
+                if(model_query.deleted_since is not None):
+                    out = self.get_deleted_impl(model_handler, model_query)
+                    self.write_output(out)
+                    return
+                if model_query.aggregate_func:
+                    out = self.get_aggregate_impl(model_handler, model_query)
+                    self.write_output(out)
+                    return
+
+                models = self.get_all_impl(model_handler, list_props,
+                                           model_query)
 
             if models is None:
                 self.not_found()
 
             self.get_if_none_match(model_handler, models, list_props)
 
+            start_time = time.time()
             out = self.models_to_xml(model_name, model_handler, models,
                                      list_props)
 
+            if(self.enable_query_stats and model_query):
+                QUERY_STATS.record(model_query.shape, len(models),
+                                   model_query.fetch_time,
+                                   time.time() - start_time)
+
         self.write_output(out)
 
+    @request_scoped
     def put(self, *_):
         """Does a REST put.
 
@@ -2236,6 +4663,7 @@ class Dispatcher(webapp.RequestHandler):
 
         self.update_impl(path, model_name, model_key, "PUT", True)
 
+    @request_scoped
     def post(self, *_):
         """Does a REST post, handles alternate HTTP methods specified via the
         'X-HTTP-Method-Override' header"""
@@ -2265,12 +4693,18 @@ class Dispatcher(webapp.RequestHandler):
                            text (200, 400, 404)
         '/<type>/<key>' -> partially updates Model instance, returns key as
                            plain text (200, 400, 404)
+        '/$batch'       -> executes a batch of operations, see batch_impl()
+                           for details
 
         """
 
         path = self.split_path(1)
         model_name = path.pop(0)
 
+        if(model_name == BATCH_PATH):
+            self.batch_impl()
+            return
+
         model_key = None
         if (len(path) > 0):
             model_key = path.pop(0)
@@ -2289,6 +4723,7 @@ class Dispatcher(webapp.RequestHandler):
         model_name = model_handler.model_name
 
         is_list = False
+        is_saved = False
         models = []
 
         if((not is_replace) and (len(path) > 0)):
@@ -2297,10 +4732,18 @@ class Dispatcher(webapp.RequestHandler):
             if(prop_name == KEY_PROPERTY_NAME):
                 raise KeyError("Property %s is not modifiable" %
                                KEY_PROPERTY_NAME)
-            model = model_handler.get(model_key)
             prop_handler = model_handler.get_property_handler(prop_name)
-            prop_handler.value_from_request(self, model, path)
-            models.append(model)
+            op = self.get_query_param(QUERY_OP_PARAM)
+            if op:
+                models.append(self.update_property_op(
+                    model_handler, model_key, prop_handler, op, path))
+                is_saved = True
+            else:
+                model = model_handler.get(model_key)
+                model_state = model_handler.get_model_state(model)
+                prop_handler.value_from_request(self, model, path)
+                model_handler.check_unchanged(model, model_state)
+                models.append(model)
 
         else:
 
@@ -2325,15 +4768,23 @@ class Dispatcher(webapp.RequestHandler):
             finally:
                 doc.unlink()
 
-        if is_list:
-            models = self.authorizer.filter_write(self, models, is_replace)
-        elif (len(models) > 0):
-            self.authorizer.can_write(self, models[0], is_replace)
+        if(not is_saved):
+            if is_list:
+                # unauthorized models are filtered, the rest are then checked
+                # as a group
+                models = self.authorizer.filter_write(self, models,
+                                                      is_replace)
+            self.authorize_write(models, is_replace)
 
-        self.update_if_match(model_handler, models)
+            self.update_if_match(model_handler, models)
 
-        for model in models:
-            ModelHandler.put(model)
+            for model in models:
+                model_handler.put_multi([model])
+
+        if(models and
+           all([getattr(model, "disp_unchanged_", False)
+                for model in models])):
+            self.response.headers[UNCHANGED_HEADER] = TRUE_VALUE
 
         self.get_if_none_match(model_handler, models)
 
@@ -2355,6 +4806,42 @@ class Dispatcher(webapp.RequestHandler):
         else:
             self.write_output(self.keys_to_text(models))
 
+    def update_property_op(self, model_handler, model_key, prop_handler, op,
+                           path):
+        """Applies the given in-place update operation (e.g. a list 'append')
+        to a single property of the Model instance with the given key.  The
+        instance is read, updated, authorized, checked against any
+        'If-Match' header and saved within a single (cross group, so that
+        Authorizers may read other entity groups) transaction, except for
+        sharded counters, whose shards are incremented in their own
+        transactions.  The transaction only makes datastore calls (it may be
+        retried), caches are updated after the commit.  Returns the updated
+        Model instance."""
+        op_value = prop_handler.read_op_value(self, op, path)
+
+        def apply_op(model):
+            if model is None:
+                self.not_found()
+            if self.enable_etags:
+                # compute pristine hash before any modifications are made
+                ModelHandler.hash_model(model)
+            model_state = model_handler.get_model_state(model)
+            prop_handler.apply_op(model, op, op_value)
+            model_handler.check_unchanged(model, model_state)
+            self.authorize_write([model], False)
+            self.update_if_match(model_handler, [model])
+            model_handler.write_multi([model])
+            return model
+
+        if prop_handler.is_transactional_op(op):
+            model = db.run_in_transaction_options(
+                db.create_transaction_options(xg=True),
+                lambda: apply_op(model_handler.model_type.get(model_key)))
+        else:
+            model = apply_op(model_handler.get(model_key))
+        model_handler.finish_put([model])
+        return model
+
     def request_structured_output(self):
         """Returns True if the request explicitly requested structured output
         (xml or json) via the accept header."""
@@ -2362,13 +4849,21 @@ class Dispatcher(webapp.RequestHandler):
         return ((out_mime_type == XML_CONTENT_TYPE) or
                 (out_mime_type == JSON_CONTENT_TYPE))
 
+    @request_scoped
     def delete(self, *_):
         """Does a REST delete.
 
         '/<type>/<key>'     -> delete Model instance w/ given key (200, 204)
+        '/<type>/<key>,...' -> delete Model instances w/ given keys (200, 204)
+        '/<type>' w/ body   -> delete Model instances w/ keys given as a list
+                               of keys in the body (200, 204)
         '/<type>[?<query>]' -> deletes all Model instances of given type,
                                optionally querying (200, 204)
 
+        Deletes by key fail with 400 for malformed keys, 404 for keys of
+        other types and 403 (or the Authorizer error code) for unauthorized
+        keys, other failures result in 204.
+
         """
 
         self.authenticator.authenticate(self)
@@ -2379,11 +4874,13 @@ class Dispatcher(webapp.RequestHandler):
         model_handler = self.get_model_handler(model_name, "DELETE", 204)
         model_name = model_handler.model_name
 
-        model_key = None
+        model_keys = None
         model_query = None
 
         if (len(path) > 0):
-            model_key = path.pop(0)
+            model_keys = path.pop(0).split(KEY_LIST_SEP)
+        elif self.request.content_length:
+            model_keys = self.keys_from_input()
         else:
             model_query = ModelQuery()
             model_query.parse(self, model_handler)
@@ -2399,13 +4896,29 @@ class Dispatcher(webapp.RequestHandler):
                                 " see 'enable_delete_all' property")
                 raise DispatcherException(404)
 
+        if((model_keys is not None) and
+           ((not model_keys) or (not all(model_keys)) or
+            (len(model_keys) > MAX_DELETE_KEYS))):
+            # missing/empty keys or too many keys
+            raise DispatcherException(400)
+
+        if (model_keys is not None):
+            # malformed keys, keys of other types and unauthorized deletes
+            # are rejected (not treated as failed deletes)
+            try:
+                model_keys = [db.Key(model_key) for model_key in model_keys]
+            except (datastore_errors.BadKeyError,
+                    datastore_errors.BadArgumentError):
+                raise DispatcherException(400)
+            for model_key in model_keys:
+                if(model_key.kind() != model_handler.model_type.kind()):
+                    raise DispatcherException(404)
+            self.authorize_delete(model_handler.model_type, model_keys)
+
         try:
-            if (model_key is not None):
-                model_key = db.Key(model_key)
-                self.authorizer.can_delete(self, model_handler.model_type,
-                                           model_key)
-                self.update_if_match(model_handler, None, (model_key,))
-                db.delete(model_key)
+            if (model_keys is not None):
+                self.update_if_match(model_handler, None, model_keys)
+                model_handler.delete(model_keys)
             else:
                 model_query.query_expr = self.authorizer.check_delete_query(
                     self, model_query.query_expr, model_query.query_params)
@@ -2418,6 +4931,286 @@ class Dispatcher(webapp.RequestHandler):
             logging.warning("delete failed", exc_info=1)
             self.error(204)
 
+    def batch_impl(self):
+        """Actual implementation of REST batch.  Executes a list of operations
+        given as xml/json of the form:
+
+            <batch>
+              <op method="GET" path="/<type>/<key>"/>
+              <op method="POST" path="/<type>[/<key>]"><type>...</type></op>
+              <op method="PUT" path="/<type>/<key>"><type>...</type></op>
+              <op method="DELETE" path="/<type>/<key>"/>
+            </batch>
+
+        Consecutive operations with the same method are executed together
+        (gets with a single batch get, updates with a single batch get and a
+        batch put per type, deletes with a batch delete per type).  The
+        result is a list of <result> elements (in operation order) with the
+        http status code of each operation, and the model (for a get) or key
+        (for an update).
+        """
+
+        if(not self.enable_batch):
+            logging.warning("batch requests are currently disabled,"
+                            " see 'enable_batch' property")
+            raise DispatcherException(404)
+
+        doc = self.input_to_xml()
+        try:
+            ops = [BatchOp(node, self.base_url)
+                   for node in doc.documentElement.childNodes
+                   if ((node.nodeType == node.ELEMENT_NODE) and
+                       (str(node.nodeName) == BATCH_OP_EL_NAME))]
+            if(len(ops) > MAX_BATCH_OPS):
+                raise DispatcherException(400)
+
+            for method, method_ops in itertools.groupby(
+                ops, lambda op: op.method):
+                method_ops = list(method_ops)
+                if(method == "GET"):
+                    self.batch_get(method_ops)
+                elif(method == "POST"):
+                    self.batch_update(method_ops, False)
+                elif(method == "PUT"):
+                    self.batch_update(method_ops, True)
+                elif(method == "DELETE"):
+                    self.batch_delete(method_ops)
+                else:
+                    for op in method_ops:
+                        op.status = 405
+
+            self.write_output(self.batch_to_xml(ops))
+        finally:
+            doc.unlink()
+
+    def batch_get(self, ops):
+        """Executes the given batch get operations with a single batch
+        get."""
+        for op in ops:
+            try:
+                op.model_handler, op.model_key = self.get_batch_op_target(
+                    op, "GET", True)
+            except BATCH_OP_ERRORS, ex:
+                self.batch_op_failed(op, ex)
+
+        ops = [op for op in ops if op.status is None]
+        models = self.get_batch_models([op.model_key for op in ops])
+        for op in ops:
+            op.result = models[op.model_key]
+            if op.result is None:
+                op.status = 404
+
+        ops = [op for op in ops if op.status is None]
+        self.authorize_batch_ops(ops, lambda auth_ops: self.authorize_read(
+            [op.result for op in auth_ops]))
+        for op in ops:
+            if op.status is None:
+                op.status = 200
+
+    def batch_update(self, ops, is_replace):
+        """Executes the given batch create/update (POST) or replace (PUT)
+        operations with a single batch get of the existing models and a
+        batch put per model type."""
+        method_name = "POST"
+        if is_replace:
+            method_name = "PUT"
+        for op in ops:
+            try:
+                op.model_handler, op.model_key = self.get_batch_op_target(
+                    op, method_name, is_replace)
+                if(len(op.model_els) != 1):
+                    raise DispatcherException(400)
+            except BATCH_OP_ERRORS, ex:
+                self.batch_op_failed(op, ex)
+
+        ops = [op for op in ops if op.status is None]
+        models = self.get_batch_models([op.model_key for op in ops
+                                        if op.model_key])
+        for op in ops:
+            try:
+                model_key = None
+                if op.model_key:
+                    if(models[op.model_key] is None):
+                        self.not_found()
+                    model_key = str(op.model_key)
+                # new models are created in the namespace of the operation
+                namespace_manager.set_namespace(op.namespace)
+                op.result = self.parse_batch_model(op, model_key, is_replace,
+                                                   models)
+            except BATCH_OP_ERRORS, ex:
+                self.batch_op_failed(op, ex)
+
+        ops = [op for op in ops if op.status is None]
+        self.authorize_batch_ops(ops, lambda auth_ops: self.authorize_write(
+            [op.result for op in auth_ops], is_replace))
+        for op in ops:
+            if op.status is not None:
+                continue
+            try:
+                self.update_if_match(op.model_handler, [op.result])
+            except BATCH_OP_ERRORS, ex:
+                self.batch_op_failed(op, ex)
+
+        ops = [op for op in ops if op.status is None]
+        for model_handler, handler_ops in self.group_batch_ops(ops):
+            try:
+                model_handler.put_multi([op.result for op in handler_ops])
+                for op in handler_ops:
+                    op.status = 200
+            except BATCH_OP_ERRORS, ex:
+                for op in handler_ops:
+                    self.batch_op_failed(op, ex)
+
+    def batch_delete(self, ops):
+        """Executes the given batch delete operations with a batch delete per
+        model type."""
+        for op in ops:
+            try:
+                op.model_handler, op.model_key = self.get_batch_op_target(
+                    op, "DELETE", True)
+            except BATCH_OP_ERRORS, ex:
+                self.batch_op_failed(op, ex)
+
+        ops = [op for op in ops if op.status is None]
+        for model_handler, handler_ops in self.group_batch_ops(ops):
+            self.authorize_batch_ops(
+                handler_ops, lambda auth_ops: self.authorize_delete(
+                    model_handler.model_type,
+                    [op.model_key for op in auth_ops]))
+            handler_ops = [op for op in handler_ops if op.status is None]
+            if(not handler_ops):
+                continue
+            try:
+                model_handler.delete([op.model_key for op in handler_ops])
+                for op in handler_ops:
+                    op.status = 200
+            except BATCH_OP_ERRORS, ex:
+                for op in handler_ops:
+                    self.batch_op_failed(op, ex)
+
+    def parse_batch_model(self, op, model_key, is_replace, models):
+        """Returns the model instance parsed from the xml of the given batch
+        create/update operation (using the given dict of prefetched models),
+        raising a DispatcherException with a 400 error code on failure."""
+        try:
+            return self.model_from_xml(
+                op.model_els[0], op.model_handler.model_name,
+                op.model_handler, model_key, is_replace, models)
+        except DispatcherException:
+            raise
+        except Exception:
+            logging.exception("failed parsing model")
+            raise DispatcherException(400)
+
+    def get_batch_op_target(self, op, method_name, requires_key):
+        """Returns the (model handler, model key) of the model targeted by
+        the given batch operation ('/<type>[/<key>]'), and records the
+        namespace of the operation (each operation path is resolved relative
+        to the namespace in effect when the request started)."""
+        if((len(op.path) < 1) or (len(op.path) > 2) or
+           (requires_key and (len(op.path) < 2))):
+            raise DispatcherException(400)
+        namespace_manager.set_namespace(self.context.namespace)
+        model_handler = self.get_model_handler(op.path[0], method_name)
+        op.namespace = namespace_manager.get_namespace()
+        model_key = None
+        if(len(op.path) > 1):
+            try:
+                model_key = db.Key(op.path[1])
+            except (datastore_errors.BadKeyError,
+                    datastore_errors.BadArgumentError):
+                raise DispatcherException(400)
+            if(model_key.kind() != model_handler.model_type.kind()):
+                raise DispatcherException(404)
+        return (model_handler, model_key)
+
+    def get_batch_models(self, model_keys):
+        """Returns a dict of the given keys to the relevant model instances
+        (or None), fetched with a single batch get."""
+        model_keys = list(set(model_keys))
+        if(not model_keys):
+            return {}
+        models = db.get(model_keys)
+        if self.enable_etags:
+            # compute pristine hashes before any modifications are made
+            found_models = [model for model in models if model]
+            ModelHandler.hash_models(found_models)
+            for model in found_models:
+                ModelHandler.cache_etag(model)
+        return dict(zip(model_keys, models))
+
+    def group_batch_ops(self, ops):
+        """Returns the given batch operations grouped by model handler, as a
+        list of (model handler, operations) tuples."""
+        handler_ops = {}
+        for op in ops:
+            handler_ops.setdefault(op.model_handler, []).append(op)
+        return handler_ops.items()
+
+    def authorize_batch_ops(self, ops, authorize):
+        """Authorizes the given batch operations as a group using the given
+        function (which takes a list of operations).  If the group is not
+        authorized, each operation is authorized individually, recording the
+        failed operations."""
+        if(not ops):
+            return
+        try:
+            authorize(ops)
+        except BATCH_OP_ERRORS:
+            for op in ops:
+                try:
+                    authorize([op])
+                except BATCH_OP_ERRORS, ex:
+                    self.batch_op_failed(op, ex)
+
+    def batch_op_failed(self, op, ex):
+        """Records the failure of the given batch operation with the given
+        exception."""
+        if(isinstance(ex, DispatcherException) and
+           (ex.error_code is not None)):
+            op.status = ex.error_code
+        else:
+            logging.warning("batch operation %s %s failed", op.method,
+                            "/".join(op.path), exc_info=1)
+            op.status = 400
+        op.result = None
+
+    def batch_to_xml(self, ops):
+        """Returns a string of xml of the results of the given batch
+        operations."""
+        blob_info_format = self.get_query_param(QUERY_BLOBINFO_PARAM,
+                                                QUERY_BLOBINFO_TYPE_KEY)
+        get_ops = [op for op in ops
+                   if ((op.method == "GET") and (op.result is not None))]
+        for model_handler, handler_ops in self.group_batch_ops(get_ops):
+            model_handler.load_counters([op.result for op in handler_ops])
+
+        impl = minidom.getDOMImplementation()
+        doc = None
+        try:
+            doc = impl.createDocument(None, BATCH_EL_NAME, None)
+            batch_el = mark_list_node(doc.documentElement)
+            for op in ops:
+                result_el = append_child(batch_el, BATCH_RESULT_EL_NAME)
+                result_el.attributes[STATUS_ATTR_NAME] = str(op.status)
+                if(op.result is None):
+                    continue
+                if(op.method == "GET"):
+                    model_el = append_child(result_el,
+                                            op.model_handler.model_name)
+                    op.model_handler.write_xml_value(
+                        model_el, op.result, blob_info_format, None)
+                else:
+                    key_el = append_child(result_el, KEY_PROPERTY_NAME,
+                                          str(op.result.key()))
+                    if getattr(op.result, "disp_unchanged_", False):
+                        key_el.attributes[UNCHANGED_ATTR_NAME] = TRUE_VALUE
+
+            return self.doc_to_output(doc)
+        finally:
+            if doc:
+                doc.unlink()
+
     def get_metadata(self, path):
         """Actual implementation of metadata retrieval.
 
@@ -2462,25 +5255,227 @@ class Dispatcher(webapp.RequestHandler):
             if doc:
                 doc.unlink()
 
-    def get_all_impl(self, model_handler, list_props):
+    def get_all_impl(self, model_handler, list_props, model_query=None):
         """Actual implementation of REST query.  Gets Model instances based
         on criteria specified in the query parameters.
         """
 
-        model_query = ModelQuery()
-        model_query.parse(self, model_handler)
+        if model_query is None:
+            model_query = ModelQuery()
+            model_query.parse(self, model_handler)
 
         model_query.query_expr = self.authorizer.check_query(
             self, model_query.query_expr, model_query.query_params)
 
-        models = model_handler.get_all(model_query)
+        if((model_query.geo_property is not None) and
+           (model_query.query_expr is not None)):
+            # query restrictions can not be applied to the geo index scans
+            self.forbidden()
+
+        if self.enable_query_stats:
+            # grab the shape before get_all() adjusts the page size
+            model_query.shape = model_query.get_shape(model_handler)
+
+        start_time = time.time()
+        try:
+            models = model_handler.get_all(model_query)
+        except datastore_errors.NeedIndexError:
+            if self.enable_query_stats:
+                QUERY_STATS.record(model_query.shape, 0, 0, 0, True)
+            raise
+        model_query.fetch_time = time.time() - start_time
 
         list_props[QUERY_OFFSET_PARAM] = model_query.next_fetch_offset
 
+        if(model_query.changes_since is not None):
+            # echo the feed start, which must be given again (along with the
+            # returned cursor offset) to resume the change query
+            list_props[QUERY_CHANGES_SINCE_PARAM] = (
+                model_handler.get_changes_handler().value_to_string(
+                    model_query.changes_since))
+
         models = self.authorizer.filter_read(self, models)
 
         return models
 
+    def get_query_stats(self):
+        """Returns the collected query statistics (see the
+        enable_query_stats property), or, if the 'type' query parameter is
+        'index', the suggested index.yaml entries for the query shapes which
+        failed due to a missing composite index.
+        """
+
+        if(not self.enable_query_stats):
+            logging.warning("query statistics are currently disabled,"
+                            " see 'enable_query_stats' property")
+            raise DispatcherException(404)
+
+        self.authorizer.can_read_query_stats(self)
+        self.context.cache_response = False
+
+        results = QUERY_STATS.load()
+
+        if(self.get_query_param(QUERY_TYPE_PARAM) == QUERY_STATS_TYPE_INDEX):
+            self.context.out_type = TEXT_CONTENT_TYPE
+            return self.query_stats_to_index_yaml(results)
+
+        impl = minidom.getDOMImplementation()
+        doc = None
+        try:
+            doc = impl.createDocument(None, QUERY_STATS_EL_NAME, None)
+            stats_el = mark_list_node(doc.documentElement)
+            for shape, counters in results:
+                (model_name, _, filters, orderings, _, page_size) = shape
+                shape_el = append_child(stats_el, SHAPE_EL_NAME)
+                shape_el.attributes[NAME_ATTR_NAME] = model_name
+                shape_el.attributes[FILTERS_ATTR_NAME] = (
+                    QUERY_ORDERING_SEPARATOR.join(
+                        [query_type + query_field
+                         for query_type, query_field in filters]))
+                shape_el.attributes[QUERY_ORDERING_PARAM] = (
+                    QUERY_ORDERING_SEPARATOR.join(
+                        [QUERY_ORDER_PREFIXES[order_idx] + query_field
+                         for query_field, order_idx in orderings]))
+                shape_el.attributes[QUERY_PAGE_SIZE_PARAM] = str(page_size)
+                for stat in (QUERY_STATS_COUNT, QUERY_STATS_MODELS,
+                             QUERY_STATS_NEED_INDEX):
+                    shape_el.attributes[stat] = str(counters[stat])
+
+                for stat in (QUERY_STATS_FETCH, QUERY_STATS_OUTPUT):
+                    stat_prefix = stat + QUERY_STATS_SEP
+                    hist_el = mark_list_node(append_child(shape_el, stat))
+                    hist_el.attributes[QUERY_STATS_TOTAL_MS] = str(
+                        counters[stat_prefix + QUERY_STATS_TOTAL_MS])
+                    for bucket in ([str(b) for b in QUERY_STATS_BUCKETS] +
+                                   [QUERY_STATS_OVERFLOW_BUCKET]):
+                        bucket_el = append_child(
+                            hist_el, BUCKET_EL_NAME,
+                            str(counters[stat_prefix + bucket]))
+                        bucket_el.attributes[BUCKET_LIMIT_ATTR_NAME] = bucket
+
+            return self.doc_to_output(doc)
+        finally:
+            if doc:
+                doc.unlink()
+
+    def query_stats_to_index_yaml(self, results):
+        """Returns index.yaml entries for the query shapes in the given query
+        statistics which failed due to a missing composite index.  The index
+        properties are the equality filter properties, followed by the
+        inequality filter property and the sort orders."""
+        lines = ["indexes:"]
+        seen_indexes = set()
+        for shape, counters in results:
+            if(not counters[QUERY_STATS_NEED_INDEX]):
+                continue
+            (_, kind, filters, orderings, inequality_field, _) = shape
+
+            eq_fields = sorted(set(
+                [query_field for query_type, query_field in filters
+                 if query_type not in QUERY_INEQUALITY_TYPES]))
+            index_props = [(query_field, QUERY_ORDER_ASC_IDX)
+                           for query_field in eq_fields]
+            if(inequality_field and
+               ((not orderings) or (orderings[0][0] != inequality_field))):
+                index_props.append((inequality_field, QUERY_ORDER_ASC_IDX))
+            index_props.extend([ordering for ordering in orderings
+                                if ordering[0] not in eq_fields])
+
+            index = (kind, tuple(index_props))
+            if(index in seen_indexes):
+                continue
+            seen_indexes.add(index)
+
+            lines.append("")
+            lines.append("- kind: %s" % kind)
+            lines.append("  properties:")
+            for query_field, order_idx in index_props:
+                lines.append("  - name: %s" % query_field)
+                if(order_idx == QUERY_ORDER_DSC_IDX):
+                    lines.append("    direction: desc")
+        lines.append("")
+        return "\n".join(lines)
+
+    def get_deleted_impl(self, model_handler, model_query):
+        """Actual implementation of REST deleted query.  Returns the keys
+        (and deletion times) of the Model instances deleted after the time
+        given in the 'deleted_since' query parameter.
+        """
+
+        tombstones = model_handler.get_deleted(model_query)
+        model_keys = self.authorizer.filter_read_deleted(
+            self, [tombstone.key().parent() for tombstone in tombstones])
+        model_keys = frozenset(model_keys)
+
+        impl = minidom.getDOMImplementation()
+        doc = None
+        try:
+            doc = impl.createDocument(None, LIST_EL_NAME, None)
+            list_el = mark_list_node(doc.documentElement)
+            list_el.attributes[QUERY_OFFSET_PARAM] = (
+                model_query.next_fetch_offset)
+            for tombstone in tombstones:
+                model_key = tombstone.key().parent()
+                if(model_key not in model_keys):
+                    continue
+                key_el = append_child(list_el, KEY_PROPERTY_NAME,
+                                      str(model_key))
+                key_el.attributes[DELETED_ATTR_NAME] = (
+                    TOMBSTONE_DELETED_HANDLER.value_to_string(
+                        tombstone.deleted))
+            # echo the feed start, which must be given again (along with the
+            # returned cursor offset) to resume the deleted query
+            list_el.attributes[QUERY_DELETED_SINCE_PARAM] = (
+                TOMBSTONE_DELETED_HANDLER.value_to_string(
+                    model_query.deleted_since))
+
+            return self.doc_to_output(doc)
+        finally:
+            if doc:
+                doc.unlink()
+
+    def get_aggregate_impl(self, model_handler, model_query):
+        """Actual implementation of REST aggregate query.  Returns the result
+        of the aggregate function (count, sum, min or max) over the Model
+        instances matching the criteria specified in the query parameters.
+        Note, the query is checked using the Authorizer's check_query(), but
+        filter_read() is never called (the Model instances are not
+        loaded).
+        """
+
+        if(not self.enable_aggregate_query):
+            logging.warning("aggregate queries are currently disabled,"
+                            " see 'enable_aggregate_query' property")
+            raise DispatcherException(404)
+
+        model_query.query_expr = self.authorizer.check_query(
+            self, model_query.query_expr, model_query.query_params)
+
+        result = model_handler.aggregate(model_query)
+
+        impl = minidom.getDOMImplementation()
+        doc = None
+        try:
+            doc = impl.createDocument(None, AGGREGATE_EL_NAME, None)
+            agg_el = doc.documentElement
+            agg_el.attributes[FUNCTION_ATTR_NAME] = model_query.aggregate_func
+            prop_handler = model_query.aggregate_handler
+            if(prop_handler is None):
+                prop_handler = AGGREGATE_COUNT_HANDLER
+            else:
+                agg_el.attributes[PROPERTY_ATTR_NAME] = (
+                    prop_handler.property_name)
+            if(result is not None):
+                txt_node = doc.createTextNode(
+                    prop_handler.value_to_string(result))
+                txt_node.disp_meta_ = prop_handler.property_type
+                agg_el.appendChild(txt_node)
+
+            return self.doc_to_output(doc)
+        finally:
+            if doc:
+                doc.unlink()
+
     def split_path(self, min_comps):
         """Returns the request path split into non-empty components."""
         path = self.request.path
@@ -2522,11 +5517,34 @@ class Dispatcher(webapp.RequestHandler):
         out_mime_type = self.request.accept.best_match(
             self.output_content_types)
         if(out_mime_type == JSON_CONTENT_TYPE):
-            self.response.disp_out_type_ = JSON_CONTENT_TYPE
+            self.context.out_type = JSON_CONTENT_TYPE
             return xml_to_json(doc)
-        self.response.disp_out_type_ = XML_CONTENT_TYPE
+        self.context.out_type = XML_CONTENT_TYPE
         return doc.toxml(XML_ENCODING)
 
+    def get_request_body(self):
+        """Returns the raw request body (for single property updates)."""
+        return self.request.body
+
+    def keys_from_input(self):
+        """Returns the list of key strings given in the request doc (either a
+        single key element or a list of key elements)."""
+        try:
+            doc = self.input_to_xml()
+        except Exception:
+            logging.exception("failed parsing keys")
+            raise DispatcherException(400)
+        try:
+            doc_el = doc.documentElement
+            if(str(doc_el.nodeName) == KEY_PROPERTY_NAME):
+                return [get_node_text(doc_el.childNodes, True)]
+            return [get_node_text(node.childNodes, True)
+                    for node in doc_el.childNodes
+                    if ((node.nodeType == node.ELEMENT_NODE) and
+                        (str(node.nodeName) == KEY_PROPERTY_NAME))]
+        finally:
+            doc.unlink()
+
     def input_to_xml(self):
         """Returns the request doc converted into an xml doc."""
         content_type = self.request.headers.get(CONTENT_TYPE_HEADER, None)
@@ -2545,16 +5563,21 @@ class Dispatcher(webapp.RequestHandler):
         if(include_props is not None):
             include_props = include_props.split(",")
 
+        if is_list_type(models):
+            model_handler.load_counters(models)
+        else:
+            model_handler.load_counters([models])
+
         impl = minidom.getDOMImplementation()
         doc = None
         try:
             if is_list_type(models):
                 doc = impl.createDocument(None, LIST_EL_NAME, None)
                 list_el = mark_list_node(doc.documentElement)
-                if((list_props is not None) and
-                   (QUERY_OFFSET_PARAM in list_props)):
-                    list_el.attributes[QUERY_OFFSET_PARAM] = (
-                        list_props[QUERY_OFFSET_PARAM])
+                if(list_props is not None):
+                    for list_prop_name, list_prop_value in (
+                        list_props.iteritems()):
+                        list_el.attributes[list_prop_name] = list_prop_value
 
                 for model in models:
                     model_el = append_child(list_el, model_name)
@@ -2583,6 +5606,130 @@ class Dispatcher(webapp.RequestHandler):
             self.not_modified()
         self.response.headers[ETAG_HEADER] = '"%s"' % model_hash
 
+    def check_cached_etag(self, etag_key):
+        """Handles the 'If-None-Match' header using the etag stored in
+        memcache under the given key, returning the not modified response
+        code if it matches.  Does nothing if the etag cache is not
+        enabled."""
+        if((not self.enable_etags) or (not self.enable_etag_cache) or
+           (IF_NONE_MATCH_HEADER not in self.request.headers)):
+            return
+
+        etag = memcache.get(etag_key, namespace=CACHE_NAMESPACE)
+        if etag and (etag in self.request.if_none_match):
+            self.response.headers[ETAG_HEADER] = '"%s"' % etag
+            self.not_modified()
+
+    def check_cached_model_etag(self, model_handler, model_key):
+        """Handles the 'If-None-Match' header for a single model get using the
+        etag cache before the model is fetched, if reading the model with the
+        given key is already known to be allowed (see
+        is_read_authorized()).  Does nothing if the etag cache is not
+        enabled."""
+        if((not self.enable_etags) or (not self.enable_etag_cache) or
+           (IF_NONE_MATCH_HEADER not in self.request.headers)):
+            return
+
+        try:
+            model_key = db.Key(model_key)
+        except (datastore_errors.BadKeyError,
+                datastore_errors.BadArgumentError):
+            # left to the actual fetch
+            return
+        if((model_key.kind() == model_handler.model_type.kind()) and
+           self.is_read_authorized(model_key)):
+            self.check_cached_etag(ETAG_CACHE_PREFIX + str(model_key))
+
+    def is_read_authorized(self, model_key):
+        """Returns True if reading the model with the given key is known to
+        be allowed without fetching the model, i.e. the default Authorizer
+        (which allows all reads) is in use, or an allowed read decision was
+        remembered for the key (see authorize())."""
+        if(type(self.authorizer) is Authorizer):
+            return True
+        principal = self.authorizer.get_principal(self)
+        decision_key = (principal, AUTH_OP_READ, str(model_key))
+        decision = self.context.auth_decisions.get(decision_key, None)
+        if((decision is None) and self.auth_cache_time and
+           (principal is not None)):
+            decision = AUTH_DECISIONS.get(decision_key)
+        return (decision is True)
+
+    def authorize_read(self, models):
+        """Returns if the given models can be read (see the Authorizer
+        can_read() and can_read_multi() methods), using any remembered
+        decisions, otherwise raises a DispatcherException."""
+        self.authorize(
+            AUTH_OP_READ, [(model.key(), model) for model in models],
+            lambda model: self.authorizer.can_read(self, model),
+            lambda models: self.authorizer.can_read_multi(self, models))
+
+    def authorize_write(self, models, is_replace):
+        """Returns if the given models can be modified (see the Authorizer
+        can_write() and can_write_multi() methods), otherwise raises a
+        DispatcherException.  Write decisions are never remembered, as they
+        depend on the modified models."""
+        if(len(models) == 1):
+            self.authorizer.can_write(self, models[0], is_replace)
+        elif models:
+            self.authorizer.can_write_multi(self, models, is_replace)
+
+    def authorize_delete(self, model_type, model_keys):
+        """Returns if the models with the given keys can be deleted (see the
+        Authorizer can_delete() and can_delete_multi() methods), using any
+        remembered decisions, otherwise raises a DispatcherException."""
+        self.authorize(
+            AUTH_OP_DELETE, [(model_key, model_key)
+                             for model_key in model_keys],
+            lambda model_key: self.authorizer.can_delete(
+                self, model_type, model_key),
+            lambda model_keys: self.authorizer.can_delete_multi(
+                self, model_type, model_keys))
+
+    def authorize(self, auth_op, keyed_items, can_single, can_multi):
+        """Authorizes the given (model key, item) tuples for the given
+        operation.  Items without a remembered decision are passed to the
+        given can_single (one item) or can_multi (multiple items) function,
+        and the resulting decisions are remembered (denials only when a
+        single item was checked)."""
+        principal = self.authorizer.get_principal(self)
+        use_shared = (self.auth_cache_time and (principal is not None))
+        pending = []
+        for model_key, item in keyed_items:
+            decision_key = (principal, auth_op, str(model_key))
+            decision = self.context.auth_decisions.get(decision_key, None)
+            if((decision is None) and use_shared):
+                decision = AUTH_DECISIONS.get(decision_key)
+            if(decision is None):
+                pending.append((decision_key, item))
+            elif(decision is not True):
+                # remembered denial (error code)
+                raise DispatcherException(decision)
+
+        if(not pending):
+            return
+
+        try:
+            if(len(pending) == 1):
+                can_single(pending[0][1])
+            else:
+                can_multi([item for _, item in pending])
+        except DispatcherException, ex:
+            if((len(pending) == 1) and (ex.error_code is not None)):
+                self.remember_auth_decision(pending[0][0], ex.error_code,
+                                            use_shared)
+            raise
+
+        for decision_key, _ in pending:
+            self.remember_auth_decision(decision_key, True, use_shared)
+
+    def remember_auth_decision(self, decision_key, decision, use_shared):
+        """Remembers the given authorization decision (True or an error code)
+        for the rest of this request, and optionally across requests."""
+        self.context.auth_decisions[decision_key] = decision
+        if use_shared:
+            AUTH_DECISIONS.put(decision_key, decision, self.auth_cache_time)
+
     def update_if_match(self, model_handler, models, model_keys=None):
         """Handles the 'If-Match' header for modifying data, either allowing
         the update to proceed or returning the precondition failed response
@@ -2595,13 +5742,12 @@ class Dispatcher(webapp.RequestHandler):
             # list or an all-collection value)
 
             if(model_keys is not None):
-                # first need to convert keys to models
-                models = []
-                for model_key in model_keys:
-                    model = model_handler.get(model_key)
-                    if model:
-                        models.append(model)
+                # first need to convert keys to models (in one batch get)
+                models = [model for model in
+                          model_handler.get_multi(list(model_keys))
+                          if model]
 
+            ModelHandler.hash_models(models)
             if(self.models_to_hash(model_handler, models) in
                self.request.if_match):
                 # provided per-collection header, which matches
@@ -2628,9 +5774,11 @@ class Dispatcher(webapp.RequestHandler):
         query offset parameter if available."""
         model_hash = 0
         if is_list_type(models):
+            ModelHandler.hash_models(models)
             if((list_props is not None) and
                (QUERY_OFFSET_PARAM in list_props)):
-                model_hash = model_hash ^ hash(list_props[QUERY_OFFSET_PARAM])
+                model_hash = model_hash ^ stable_hash(
+                    list_props[QUERY_OFFSET_PARAM])
             for model in models:
                 model_hash = model_hash ^ ModelHandler.hash_model(model)
         else:
@@ -2649,13 +5797,18 @@ class Dispatcher(webapp.RequestHandler):
                 list_el = mark_list_node(doc.documentElement)
 
                 for model in models:
-                    append_child(list_el, KEY_PROPERTY_NAME,
-                                 model_handler.key_handler.get_value_as_string(
-                                     model))
+                    key_el = append_child(
+                        list_el, KEY_PROPERTY_NAME,
+                        model_handler.key_handler.get_value_as_string(model))
+                    if getattr(model, "disp_unchanged_", False):
+                        key_el.attributes[UNCHANGED_ATTR_NAME] = TRUE_VALUE
             else:
                 doc = impl.createDocument(None, KEY_PROPERTY_NAME, None)
                 doc.documentElement.appendChild(doc.createTextNode(
                     model_handler.key_handler.get_value_as_string(models)))
+                if getattr(models, "disp_unchanged_", False):
+                    doc.documentElement.attributes[UNCHANGED_ATTR_NAME] = (
+                        TRUE_VALUE)
 
             return self.doc_to_output(doc)
         finally:
@@ -2670,9 +5823,10 @@ class Dispatcher(webapp.RequestHandler):
         return unicode(",".join([str(model.key()) for model in models]))
 
     def model_from_xml(self, model_el, model_name, model_handler, key,
-                       is_replace):
+                       is_replace, prefetched_models=None):
         """Returns a model instance updated from the given model xml
-        element."""
+        element (using the given dict of already fetched models, if
+        any)."""
         if(model_name != str(model_el.nodeName)):
             raise TypeError("wrong model name, found '%s', expected '%s'" %
                             (model_el.nodeName, model_name))
@@ -2694,11 +5848,17 @@ class Dispatcher(webapp.RequestHandler):
                 raise ValueError(
                     "key in data %s does not match request key %s" %
                     (given_key, key))
-            model = model_handler.get(key)
+            if((prefetched_models is not None) and
+               (key in prefetched_models)):
+                model = prefetched_models[key]
+            else:
+                model = model_handler.get(key)
+            model_state = model_handler.get_model_state(model)
 
             if(is_replace):
                 for prop_name, prop_type in model.properties().iteritems():
-                    if(prop_name not in props):
+                    if((prop_name not in props) and
+                       (prop_name not in model_handler.sharded_counters)):
                         setattr(model, prop_name, prop_type.default_value())
                 for prop_name in model.dynamic_properties():
                     delattr(model, prop_name)
@@ -2706,6 +5866,9 @@ class Dispatcher(webapp.RequestHandler):
             for prop_name, prop_value in props.iteritems():
                 setattr(model, prop_name, prop_value)
 
+            # skip the datastore write if nothing actually changed
+            model_handler.check_unchanged(model, model_state)
+
         else:
             new_model = True
             model = model_handler.create(props)
@@ -2721,7 +5884,7 @@ class Dispatcher(webapp.RequestHandler):
     def write_output(self, out):
         """Writes the output to the response."""
         if out:
-            content_type = self.response.disp_out_type_
+            content_type = self.context.out_type
             out_suffix = None
             if(content_type == JSON_CONTENT_TYPE):
                 # check for json callback
@@ -2739,7 +5902,7 @@ class Dispatcher(webapp.RequestHandler):
     def serve_blob(self, blob_info):
         """Serves a BlobInfo response."""
         self.response.clear()
-        self.response.disp_cache_resp_ = False
+        self.context.cache_response = False
 
         content_type_preferred = None
         if blob_info:
@@ -2755,6 +5918,32 @@ class Dispatcher(webapp.RequestHandler):
         self.set_response_content_type(BINARY_CONTENT_TYPE,
                                        content_type_preferred)
 
+    def write_ranged_output(self, value):
+        """Writes the given (byte string) value to the response, or just the
+        requested part of the value (206) if the request has a satisfiable
+        single byte range 'Range' header (416 if not satisfiable)."""
+        self.response.headers[ACCEPT_RANGES_HEADER] = BYTES_RANGE_UNIT
+        range_header = self.request.headers.get(RANGE_HEADER, None)
+        byte_range = None
+        if range_header:
+            byte_range = parse_byte_range(range_header, len(value))
+        if byte_range is None:
+            self.response.out.write(value)
+            return
+
+        # partial responses are not cached
+        self.context.cache_response = False
+        start, end = byte_range
+        if(start >= len(value)):
+            self.response.headers[CONTENT_RANGE_HEADER] = "%s */%d" % (
+                BYTES_RANGE_UNIT, len(value))
+            raise DispatcherException(416)
+
+        self.response.set_status(206)
+        self.response.headers[CONTENT_RANGE_HEADER] = "%s %d-%d/%d" % (
+            BYTES_RANGE_UNIT, start, end, len(value))
+        self.response.out.write(value[start:end + 1])
+
     def upload_blob(self, path, model, blob_prop_name):
         """Handles a BlobInfo upload to the property with the given name of
         the given model instance."""
@@ -2806,9 +5995,11 @@ class Dispatcher(webapp.RequestHandler):
             # authorize the update, post upload.  we need to do this here,
             # because we have to return a redirect now (the final result is
             # not returned until after the redirect)
-            self.authorizer.can_write(self, model, False)
+            self.authorize_write([model], False)
 
-            ModelHandler.put(model)
+            model_handler = self.get_model_handler(self.split_path(1)[0],
+                                                   "POST")
+            model_handler.put_multi([model])
 
             # redirect will be a GET, so we need to send the caller to a
             # special url, so they can get output which looks like what would
@@ -2837,10 +6028,10 @@ class Dispatcher(webapp.RequestHandler):
     def get_query_params(self):
         """Returns the parsed request url query params as a dict."""
         # lazy (re)parse query params
-        if(self.request.disp_query_params_ is None):
-            self.request.disp_query_params_ = cgi.parse_qs(
+        if(self.context.query_params is None):
+            self.context.query_params = cgi.parse_qs(
                 self.request.query_string)
-        return self.request.disp_query_params_
+        return self.context.query_params
 
     def get_query_param(self, key, default=None):
         """Returns the request url query param for the given key, defaulting
@@ -2860,7 +6051,7 @@ class Dispatcher(webapp.RequestHandler):
             if((not content_type) or (content_type.find("*") >= 0)):
                 content_type = content_type_default
         self.response.headers[CONTENT_TYPE_HEADER] = content_type
-        self.response.disp_out_type_ = content_type
+        self.context.out_type = content_type
 
     def forbidden(self):
         """Convenience method which raises a DispatcherException with a 403
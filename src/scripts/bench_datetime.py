@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Boomi, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Micro-benchmark comparing the DateTimeHandler iso parsing with the
+original strptime based parsing (and verifying that values round-trip).
+
+Must be run from the base project dir with the App Engine SDK on the
+PYTHONPATH:
+
+    PYTHONPATH=<sdk>:<sdk>/lib/webob src/scripts/bench_datetime.py
+"""
+
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, "src/main/python")
+
+from google.appengine.ext import db
+
+import rest
+
+NUM_RUNS = 20000
+
+VALUES = [
+    (db.DateTimeProperty(), datetime(2012, 3, 4, 5, 6, 7, 123456)),
+    (db.DateTimeProperty(), datetime(2012, 3, 4, 5, 6, 7)),
+    (db.TimeProperty(), datetime(1900, 1, 1, 23, 59, 1, 42).time()),
+    (db.DateProperty(), datetime(2012, 12, 31).date())]
+
+
+def strptime_parse_date_time(dt_str, dt_format, dt_type,
+                             allows_microseconds):
+    """The original (strptime only) rest.parse_date_time()."""
+    micros = None
+    if(allows_microseconds):
+        dt_parts = dt_str.rsplit(".", 1)
+        dt_str = dt_parts.pop(0)
+        if(len(dt_parts) > 0):
+            micros = int(dt_parts[0].ljust(6, "0")[:6])
+    dtime = datetime.strptime(dt_str, dt_format)
+    if(micros):
+        dtime = dtime.replace(microsecond=micros)
+    if(dt_type is datetime.date):
+        dtime = dtime.date()
+    elif(dt_type is datetime.time):
+        dtime = dtime.time()
+    return dtime
+
+
+def main():
+    for prop_type, value in VALUES:
+        prop_type.name = "value"
+        handler = rest.DateTimeHandler("value", prop_type)
+        value_str = handler.value_to_string(value)
+        args = (value_str, handler.dt_format, handler.dt_type,
+                handler.allows_microseconds)
+
+        parsed = handler.value_from_xml_string(value_str)
+        if((parsed != value) or
+           (parsed != strptime_parse_date_time(*args))):
+            print "round-trip failed for %s: %r" % (value_str, parsed)
+            sys.exit(1)
+
+        fast_time = timeit.timeit(lambda: rest.parse_date_time(*args),
+                                  number=NUM_RUNS)
+        strptime_time = timeit.timeit(
+            lambda: strptime_parse_date_time(*args), number=NUM_RUNS)
+        format_time = timeit.timeit(lambda: handler.value_to_string(value),
+                                    number=NUM_RUNS)
+        print "%-28s parse %.3fs (strptime %.3fs, %.1fx)  format %.3fs" % (
+            value_str, fast_time, strptime_time, strptime_time / fast_time,
+            format_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Boomi, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Checks the error handling of batch requests: operations with bad paths or
+keys must fail individually (with the expected status code) without failing
+the rest of the batch.
+
+Must be run from the base project dir with the App Engine SDK (and its
+webapp2/webob libs) on the PYTHONPATH:
+
+    PYTHONPATH=<sdk>:<sdk>/lib/webapp2-2.5.2:<sdk>/lib/webob-1.2.3 \\
+        src/scripts/check_batch.py
+"""
+
+import os
+import sys
+from xml.dom import minidom
+
+sys.path.insert(0, "src/main/python")
+
+# use webapp2 (as in the python27 runtime)
+os.environ["APPENGINE_RUNTIME"] = "python27"
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import webapp2
+import webob
+
+import rest
+
+
+class Widget(db.Model):
+    name = db.StringProperty()
+
+
+def setup():
+    """Sets up the datastore/memcache stubs and the test models, returns the
+    (testbed, key of an existing Widget)."""
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+
+    rest.Dispatcher.enable_batch = True
+    rest.Dispatcher.add_model("Widget", Widget)
+    return (bed, Widget(name="existing").put())
+
+
+def run_batch(app, ops):
+    """Runs a batch request with the given list of (method, path) operations,
+    returns the (response status, list of operation status codes)."""
+    body = "<batch>%s</batch>" % "".join(
+        ['<op method="%s" path="%s"/>' % op for op in ops])
+    request = webob.Request.blank("/%s" % rest.BATCH_PATH)
+    request.method = "POST"
+    request.content_type = rest.XML_CONTENT_TYPE
+    request.body = body
+    response = request.get_response(app)
+    if(response.status_int != 200):
+        return (response.status_int, None)
+    doc = minidom.parseString(response.body)
+    statuses = [int(result_el.getAttribute(rest.STATUS_ATTR_NAME))
+                for result_el in doc.getElementsByTagName(
+                    rest.BATCH_RESULT_EL_NAME)]
+    doc.unlink()
+    return (response.status_int, statuses)
+
+
+def check(problems, name, app, ops, expected):
+    """Runs the given batch operations, recording a problem if the operation
+    status codes do not match the expected codes."""
+    status, statuses = run_batch(app, ops)
+    if(statuses != expected):
+        problems.append("%s: status %d, operation statuses %s, expected %s" %
+                        (name, status, statuses, expected))
+
+
+def main():
+    bed, widget_key = setup()
+    try:
+        app = webapp2.WSGIApplication([("/.*", rest.Dispatcher)])
+        problems = []
+
+        check(problems, "garbage key get", app,
+              [("GET", "/Widget/not-a-key"), ("GET", "/Widget/%s" %
+                                               widget_key)],
+              [400, 200])
+        check(problems, "garbage key delete", app,
+              [("DELETE", "/Widget/garbage!"), ("GET", "/Widget/%s" %
+                                               widget_key)],
+              [400, 200])
+        check(problems, "missing key", app,
+              [("GET", "/Widget"), ("GET", "/Widget/%s" % widget_key)],
+              [400, 200])
+
+        for problem in problems:
+            print problem
+        if problems:
+            print "%d problems found" % len(problems)
+            sys.exit(1)
+        print "batch checks ok"
+    finally:
+        bed.deactivate()
+
+
+if __name__ == "__main__":
+    main()
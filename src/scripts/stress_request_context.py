@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Boomi, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Concurrency stress test for the request scoped Dispatcher state.  Runs
+many concurrent requests (each for a different namespace, query and output
+format) and verifies that no request state leaks between requests: every
+response only contains the models of its own namespace/query in its own
+format, the namespace is restored after every request, and the model handler
+registry is frozen after the first request.
+
+Must be run from the base project dir with the App Engine SDK (and its
+webapp2/webob libs) on the PYTHONPATH:
+
+    PYTHONPATH=<sdk>:<sdk>/lib/webapp2-2.5.2:<sdk>/lib/webob-1.2.3 \\
+        src/scripts/stress_request_context.py
+"""
+
+import json
+import os
+import sys
+import threading
+from xml.dom import minidom
+
+sys.path.insert(0, "src/main/python")
+
+# use webapp2 (as in the python27 runtime)
+os.environ["APPENGINE_RUNTIME"] = "python27"
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+from google.appengine.runtime import request_environment
+
+import webapp2
+import webob
+
+import rest
+
+NUM_THREADS = 16
+NUM_REQUESTS = 200
+NAMESPACES = ["ns%d" % idx for idx in xrange(4)]
+ACCEPT_TYPES = [rest.XML_CONTENT_TYPE, rest.JSON_CONTENT_TYPE]
+
+
+class Widget(db.Model):
+    name = db.StringProperty()
+    color = db.StringProperty()
+
+
+def setup():
+    """Sets up the datastore/memcache stubs, a request local os.environ (like
+    the threadsafe python27 runtime) and the test models."""
+    request_environment.PatchOsEnviron()
+    request_environment.current_request.Init(None, dict(os.environ))
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+
+    for namespace in NAMESPACES:
+        namespace_manager.set_namespace(namespace)
+        for color in ("red", "blue"):
+            Widget(name=namespace, color=color).put()
+    namespace_manager.set_namespace("")
+
+    rest.Dispatcher.external_namespaces = rest.FULL_EXT_NAMESPACES
+    rest.Dispatcher.add_model("Widget", Widget)
+    return bed
+
+
+def get_values(response, prop_name):
+    """Returns the (distinct, sorted) values of the given property of the
+    models in the given xml or json response."""
+    values = set()
+    if response.content_type.startswith(rest.JSON_CONTENT_TYPE):
+        def add_values(obj):
+            if isinstance(obj, dict):
+                for key, value in obj.iteritems():
+                    if(key == prop_name):
+                        values.add(value)
+                    else:
+                        add_values(value)
+            elif isinstance(obj, list):
+                for value in obj:
+                    add_values(value)
+        add_values(json.loads(response.body))
+    else:
+        doc = minidom.parseString(response.body)
+        for prop_el in doc.getElementsByTagName(prop_name):
+            values.add(rest.get_node_text(prop_el.childNodes, True))
+        doc.unlink()
+    return sorted(values)
+
+
+def check_request(app, idx):
+    """Makes a single request and returns a list of problems (if any)."""
+    namespace = NAMESPACES[idx % len(NAMESPACES)]
+    color = ("red", "blue")[(idx // len(NAMESPACES)) % 2]
+    accept = ACCEPT_TYPES[(idx // (2 * len(NAMESPACES))) % 2]
+
+    request = webob.Request.blank("/%s.Widget?feq_color=%s" %
+                                  (namespace, color))
+    request.headers["Accept"] = accept
+    response = request.get_response(app)
+
+    problems = []
+    if(response.status_int != 200):
+        problems.append("status %d" % response.status_int)
+    if(not response.content_type.startswith(accept)):
+        problems.append("content type %s, expected %s" %
+                        (response.content_type, accept))
+    elif(get_values(response, "name") != [namespace]):
+        problems.append("found models of namespaces %s" %
+                        get_values(response, "name"))
+    elif(get_values(response, "color") != [color]):
+        problems.append("found models with colors %s" %
+                        get_values(response, "color"))
+    if(namespace_manager.get_namespace() != ""):
+        problems.append("namespace %r not restored" %
+                        namespace_manager.get_namespace())
+    return ["/%s.Widget (%s, %s): %s" % (namespace, color, accept, problem)
+            for problem in problems]
+
+
+def run_requests(app, environ, thread_idx, problems):
+    """Runs NUM_REQUESTS requests in the current thread."""
+    request_environment.current_request.Init(None, dict(environ))
+    for req_idx in xrange(NUM_REQUESTS):
+        thread_problems = check_request(app, thread_idx + req_idx)
+        if thread_problems:
+            problems.extend(thread_problems)
+
+
+def main():
+    bed = setup()
+    try:
+        app = webapp2.WSGIApplication([("/.*", rest.Dispatcher)])
+        environ = dict(os.environ)
+
+        # the first request freezes the model handler registry
+        problems = check_request(app, 0)
+        try:
+            rest.Dispatcher.add_model("Gadget", Widget)
+            problems.append("model added after the first request")
+        except ValueError:
+            pass
+
+        threads = [threading.Thread(target=run_requests,
+                                    args=(app, environ, idx, problems))
+                   for idx in xrange(NUM_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for problem in problems[:20]:
+            print problem
+        if problems:
+            print "%d problems found" % len(problems)
+            sys.exit(1)
+        print "%d concurrent requests ok" % (NUM_THREADS * NUM_REQUESTS)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == "__main__":
+    main()